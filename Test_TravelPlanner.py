@@ -1,32 +1,28 @@
 import re, string, os, sys
 import time
+# start of the module import, for the startup time --replay reports
+_import_start = time.perf_counter()
+import queue
+import shutil
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 import json
 import pdb
-import openai
 import argparse
 
 import pandas as pd
 from pandas import DataFrame
 import importlib
-import tiktoken
 from datetime import datetime
 from tqdm import tqdm
-from datasets import load_dataset
 from z3 import *
-from openai_func import *
-from open_source_models import *
+from utils.llm_cache import llm_cache
+from utils.step_templates import templated_step_code
+from utils.solver_program import SolverProgram
 from typing import List, Dict, Any
-
-from langchain.chat_models import ChatOpenAI
-from langchain.callbacks import get_openai_callback
-from langchain.llms.base import BaseLLM
-from langchain.prompts import PromptTemplate
-from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain.schema import (
-    AIMessage,
-    HumanMessage,
-    SystemMessage
-)
+# The LLM backends (openai_func: openai, anthropic, mistralai; open_source_models: torch, transformers)
+# and the dataset loader are imported where they are first used, so that replaying saved solver code
+# with --replay only pays for z3, pandas and the tool tables.
 
 sys.path.append(os.path.abspath(os.path.join(os.getcwd(), "..")))
 sys.path.append(os.path.abspath(os.path.join(os.getcwd(), "tools/planner")))
@@ -41,7 +37,10 @@ from tools.googleDistanceMatrix.apis import *
 from tools.restaurants.apis import *
 
 
-OPENAI_API_KEY = os.environ['OPENAI_API_KEY']
+OPENAI_API_KEY = os.environ.get('OPENAI_API_KEY')
+# modules --replay must not import, and the seconds its startup may take
+REPLAY_UNUSED_MODULES = ['torch', 'transformers', 'langchain', 'openai', 'anthropic', 'mistralai', 'datasets']
+REPLAY_STARTUP_SECONDS = float(os.environ.get('REPLAY_STARTUP_SECONDS', 3))
 # GOOGLE_API_KEY = os.environ['GOOGLE_API_KEY']
 
 actionMapping = {"FlightSearch":"flights","AttractionSearch":"attractions","GoogleDistanceMatrix":"googleDistanceMatrix","accommodationSearch":"accommodation","RestaurantSearch":"restaurants","CitySearch":"cities"}
@@ -99,13 +98,133 @@ def get_city_list(city, day, departure_dates):
         city_list.append(IntVal(-1))
     return city_list
 
-def generate_as_plan(s, variables, query):
-    CitySearch = Cities()
-    FlightSearch = Flights()
-    AttractionSearch = Attractions()
-    DistanceSearch = GoogleDistanceMatrix()
-    AccommodationSearch = Accommodations()
-    RestaurantSearch = Restaurants()
+def indent_step_code(code, days):
+    # every step but the destination cities runs inside the city loops of the destination code
+    if days == 3:
+        return code.replace('\n', '\n    ')
+    elif days == 5:
+        return code.replace('\n', '\n            ')
+    else:
+        return code.replace('\n', '\n                ')
+
+# steps whose constraints do not depend on the destination cities
+CITY_INDEPENDENT_STEPS = ['Departure dates', 'Transportation methods']
+
+def assemble_incremental_segments(step_codes, days):
+    """
+    Order the step codes for incremental solving: the city-independent steps are asserted once on the
+    shared solver, each destination city combination pushes a scope instead of creating a new Optimize(),
+    and the incremental solve template pops it at the same loop level once the combination is done, so
+    that combinations skipped by the destination code's guard do not leave scopes open.
+    Return None when the destination code does not create its solver the way the prompt examples do.
+    """
+    hoisted = []
+    segments = []
+    for step_key, code in step_codes:
+        if step_key in CITY_INDEPENDENT_STEPS:
+            hoisted.append((step_key, code + '\n'))
+        elif step_key == 'Destination cities':
+            code, count = re.subn(r'^([ \t]*)s = Optimize\(\)', r'\1s.push()', code, flags=re.M)
+            if count == 0:
+                return None
+            segments.append((step_key, code + '\n'))
+        else:
+            segments.append((step_key, indent_step_code(code, days) + '\n'))
+    with open('prompts/solve_{}_incremental.txt'.format(days), 'r') as f:
+        return hoisted + segments + [('Solve', f.read())]
+
+def assemble_segments(step_codes, days, incremental = False):
+    """Order the step codes and the solve template the way the pipeline executes them."""
+    if incremental:
+        segments = assemble_incremental_segments(step_codes, days)
+        if segments is not None:
+            return segments
+    segments = [(step_key, (code if step_key == 'Destination cities' else indent_step_code(code, days)) + '\n') for step_key, code in step_codes]
+    with open('prompts/solve_{}.txt'.format(days), 'r') as f:
+        return segments + [('Solve', f.read())]
+
+def partition_destination_code(code, worker, workers):
+    """
+    Keep every `workers`-th destination city combination of the destination code, starting at `worker`,
+    by skipping the others before their solver is created.
+    Return None when the destination code does not create its solver the way the prompt examples do.
+    """
+    if re.search(r'^[ \t]*s = Optimize\(\)', code, flags=re.M) is None:
+        return None
+    skip = '{0}combination_index += 1\n{0}if combination_index % {1} != {2}: continue\n{0}s = Optimize()'
+    code = re.sub(r'^([ \t]*)s = Optimize\(\)', lambda match: skip.format(match.group(1), workers, worker), code, flags=re.M)
+    return '\ncombination_index = -1' + code
+
+def solve_partition(segments, namespace, worker, results):
+    # runs in a forked worker, with its own solver and its own plans folder
+    namespace = dict(namespace, s = Optimize(), variables = {})
+    try:
+        SolverProgram(segments).run(globals(), namespace)
+        results.put((worker, os.path.exists(namespace['path'] + 'plans/plan.txt'), None))
+    except Exception as e:
+        results.put((worker, False, str(e)))
+
+def solve_in_parallel(step_codes, days, namespace, workers, incremental = False):
+    """
+    Split the destination city combinations of the generated code over `workers` forked processes and
+    stop the others as soon as one of them finds a plan, which is then copied to the plans folder at
+    namespace['path']. Return whether a plan was found, or None when the destination code cannot be split.
+    """
+    path = namespace['path']
+    context = multiprocessing.get_context('fork')
+    results = context.Queue()
+    processes = []
+    for worker in range(workers):
+        worker_codes = []
+        for step_key, code in step_codes:
+            if step_key == 'Destination cities':
+                code = partition_destination_code(code, worker, workers)
+                if code is None:
+                    return None
+            worker_codes.append((step_key, code))
+        worker_path = path + f'workers/{worker}/'
+        os.makedirs(worker_path + 'plans/', exist_ok=True)
+        process = context.Process(target=solve_partition, args=(assemble_segments(worker_codes, days, incremental), dict(namespace, path = worker_path), worker, results))
+        processes.append(process)
+    for process in processes:
+        process.start()
+
+    found = False
+    errors = []
+    pending = workers
+    while pending > 0 and not found:
+        try:
+            worker, success, error = results.get(timeout=1)
+        except queue.Empty:
+            # a worker that died without reporting (e.g. killed by the OS) must not block the others
+            if not any(process.is_alive() for process in processes) and results.empty():
+                break
+            continue
+        pending -= 1
+        if error is not None:
+            errors.append(error)
+        if success:
+            shutil.copy(path + f'workers/{worker}/plans/plan.txt', path + 'plans/plan.txt')
+            found = True
+    for process in processes:
+        process.terminate()
+        process.join()
+    shutil.rmtree(path + 'workers/', ignore_errors=True)
+    if not found and len(errors) > 0:
+        raise RuntimeError(errors[0])
+    return found
+
+def generate_as_plan(s, variables, query, searches = None):
+    # decode against the candidate rows the search tools kept while encoding, so that model indices
+    # refer to the same (possibly pruned) rows and no table is scanned again; tools the solver code
+    # was not built with are created and searched as before
+    searches = searches or {}
+    FlightSearch = searches.get('FlightSearch') or Flights()
+    AttractionSearch = searches.get('AttractionSearch') or Attractions()
+    DistanceSearch = searches.get('DistanceSearch') or GoogleDistanceMatrix()
+    AccommodationSearch = searches.get('AccommodationSearch') or Accommodations()
+    RestaurantSearch = searches.get('RestaurantSearch') or Restaurants()
+    model = s.model()
     cities = []
     transportation = []
     departure_dates = []
@@ -117,60 +236,56 @@ def generate_as_plan(s, variables, query):
         cities = [query['dest']]
         cities_list = [query['dest']]
     else:
-        cities_list = CitySearch.run(query['dest'], query['org'], query['date'])
-        if query['org'] in cities_list:
-            cities_list.remove(query['org'])
+        cities_list = AccommodationSearch.all_cities
+        if cities_list is None:
+            cities_list = Cities().run(query['dest'], query['org'], query['date'])
+            if query['org'] in cities_list:
+                cities_list.remove(query['org'])
         for city in variables['city']:
-            cities.append(cities_list[int(s.model()[city].as_long())])
+            cities.append(cities_list[int(model[city].as_long())])
     for i, flight in enumerate(variables['flight']):
-        if bool(s.model()[flight]):
+        if bool(model[flight]):
             transportation.append('flight')
-        elif bool(s.model()[variables['self-driving'][i]]):
+        elif bool(model[variables['self-driving'][i]]):
             transportation.append('self-driving')
         else:
             transportation.append('taxi')
     for date_index in variables['departure_dates']:
-        departure_dates.append(query['date'][int(s.model()[date_index].as_long())])
+        departure_dates.append(query['date'][int(model[date_index].as_long())])
     dest_cities = [query['org']] + cities + [query['org']]
     for i, index in enumerate(variables['flight_index']):
         if transportation[i] == 'flight':
-            flight_index = int(s.model()[index].as_long())
-            flight_list = FlightSearch.run(dest_cities[i], dest_cities[i+1], departure_dates[i])
-            # flight_info = f'Flight Number: {np.array(flight_list['Flight Number'])[flight_index]}, from {np.array(flight_list['OriginCityName'])[flight_index]} to {np.array(flight_list['DestCityName'])[flight_index]}, Departure Time: {np.array(flight_list['DepTime'])[flight_index]}, Arrival Time: {np.array(flight_list['ArrTime'])[flight_index]}'
-            flight_info = 'Flight Number: {}, from {} to {}, Departure Time: {}, Arrival Time: {}'.format(np.array(flight_list['Flight Number'])[flight_index], np.array(flight_list['OriginCityName'])[flight_index], np.array(flight_list['DestCityName'])[flight_index], np.array(flight_list['DepTime'])[flight_index], np.array(flight_list['ArrTime'])[flight_index])
+            flight_index = int(model[index].as_long())
+            flight = FlightSearch.encoded_candidates(dest_cities[i], dest_cities[i+1], departure_dates[i]).iloc[flight_index]
+            flight_info = 'Flight Number: {}, from {} to {}, Departure Time: {}, Arrival Time: {}'.format(flight['Flight Number'], flight['OriginCityName'], flight['DestCityName'], flight['DepTime'], flight['ArrTime'])
             transportation_info.append(flight_info)
         elif transportation[i] == 'self-driving':
             transportation_info.append('Self-' + DistanceSearch.run(dest_cities[i], dest_cities[i+1], mode='driving'))
         else:
-            # pdb.set_trace()
             transportation_info.append(DistanceSearch.run(dest_cities[i], dest_cities[i+1], mode='taxi'))
     for i,which_city in enumerate(variables['restaurant_in_which_city']):
-        # pdb.set_trace()
-        city_index = int(s.model()[which_city].as_long())
+        city_index = int(model[which_city].as_long())
         if city_index == -1:
             restaurant_city_list.append('-')
         else:
             city = cities_list[city_index]
-            restaurant_list = RestaurantSearch.run(city)
-            restaurant_index = int(s.model()[variables['restaurant_index'][i]].as_long())
-            restaurant = np.array(restaurant_list['Name'])[restaurant_index]
+            restaurant_index = int(model[variables['restaurant_index'][i]].as_long())
+            restaurant = RestaurantSearch.encoded_candidates(city)['Name'].iloc[restaurant_index]
             restaurant_city_list.append(restaurant + ', ' + city)
 
     for i,which_city in enumerate(variables['attraction_in_which_city']):
-        city_index = int(s.model()[which_city].as_long())
+        city_index = int(model[which_city].as_long())
         if city_index == -1:
             attraction_city_list.append('-')
         else:
             city = cities_list[city_index]
-            attraction_list = AttractionSearch.run(city)
-            attraction_index = int(s.model()[variables['attraction_index'][i]].as_long())
-            attraction = np.array(attraction_list['Name'])[attraction_index]
+            attraction_index = int(model[variables['attraction_index'][i]].as_long())
+            attraction = AttractionSearch.encoded_candidates(city)['Name'].iloc[attraction_index]
             attraction_city_list.append(attraction + ', ' + city)
 
     for i,city in enumerate(cities):
-        accommodation_list = AccommodationSearch.run(city)
-        accommodation_index = int(s.model()[variables['accommodation_index'][i]].as_long())
-        accommodation = np.array(accommodation_list['NAME'])[accommodation_index]
+        accommodation_index = int(model[variables['accommodation_index'][i]].as_long())
+        accommodation = AccommodationSearch.encoded_candidates(city)['NAME'].iloc[accommodation_index]
         accommodation_city_list.append(accommodation + ', ' + city)
     print(cities)
     print(transportation)
@@ -181,12 +296,23 @@ def generate_as_plan(s, variables, query):
     print(accommodation_city_list)
     return f'Destination cities: {cities},\nTransportation dates: {departure_dates},\nTransportation methods between cities: {transportation_info},\nRestaurants (3 meals per day): {restaurant_city_list},\nAttractions (1 per day): {attraction_city_list},\nAccommodations (1 per city): {accommodation_city_list}'
 
-def pipeline(query, mode, model, index, model_version = None):
-    path =  f'output/{mode}/{model}_nl/{index}/'
+def query_path(mode, model, index):
+    return f'output/{mode}/{model}_nl/{index}/'
+
+def query_finished(mode, model, index):
+    # pipeline writes time.txt last, and error.txt only when the generated code failed
+    path = query_path(mode, model, index) + 'plans/'
+    return os.path.exists(path + 'time.txt') and not os.path.exists(path + 'error.txt')
+
+def pipeline(query, mode, model, index, model_version = None, encoding = 'array', prune = False, incremental = False, workers = 1, max_concurrency = 8, step_cache = False, quantize = None, threads = None, max_memory_gb = None):
+    path =  query_path(mode, model, index)
     if not os.path.exists(path):
         os.makedirs(path)
         os.makedirs(path+'codes/')
         os.makedirs(path+'plans/')
+    # a rerun replaces the outcome of an earlier failed attempt
+    if os.path.exists(path+'plans/' + 'error.txt'):
+        os.remove(path+'plans/' + 'error.txt')
     # setup
     with open('prompts/query_to_json.txt', 'r') as file:
         query_to_json_prompt = file.read()
@@ -214,11 +340,12 @@ def pipeline(query, mode, model, index, model_version = None):
     CitySearch = Cities()
     # CitySearch.run('Texas', 'Seattle',["2022-03-10", "2022-03-11", "2022-03-12", "2022-03-13", "2022-03-14", "2022-03-15", "2022-03-16"])
     # pdb.set_trace()
-    FlightSearch = Flights()
+    FlightSearch = Flights(encoding=encoding)
     AttractionSearch = Attractions()
     DistanceSearch = GoogleDistanceMatrix()
-    AccommodationSearch = Accommodations()
-    RestaurantSearch = Restaurants()
+    AccommodationSearch = Accommodations(encoding=encoding)
+    RestaurantSearch = Restaurants(encoding=encoding)
+    searches = {'FlightSearch': FlightSearch, 'AttractionSearch': AttractionSearch, 'DistanceSearch': DistanceSearch, 'AccommodationSearch': AccommodationSearch, 'RestaurantSearch': RestaurantSearch}
     s = Optimize()
     variables = {}
     times = []
@@ -236,18 +363,23 @@ def pipeline(query, mode, model, index, model_version = None):
     plan = ''
     plan_json = ''
     codes = ''
+    step_codes = []
     success = False
 
-    if(model == 'qwen'): qwen_llm = LLMWrapper("qwen")
-    elif(model == 'phi'): phi_llm = LLMWrapper("phi")
+    if model in ['gpt', 'claude', 'mixtral']:
+        from openai_func import GPT_response, Claude_response, Mixtral_response
+    elif model in ['qwen', 'phi']:
+        from open_source_models import LLMWrapper
+    if(model == 'qwen'): qwen_llm = LLMWrapper("qwen", quantize = quantize, threads = threads, max_memory_gb = max_memory_gb)
+    elif(model == 'phi'): phi_llm = LLMWrapper("phi", quantize = quantize, threads = threads, max_memory_gb = max_memory_gb)
 
     try:
         # json generated for postprocess only, not used in inputs to LLMs
         if model == 'gpt': query_json = json.loads(GPT_response(query_to_json_prompt + '{' + query + '}\n' + 'JSON:\n', model_version).replace('```json', '').replace('```', ''))
         elif model == 'claude': query_json = json.loads(Claude_response(query_to_json_prompt + '{' + query + '}\n' + 'JSON:\n').replace('```json', '').replace('```', ''))
         elif model == 'mixtral': query_json = json.loads(Mixtral_response(query_to_json_prompt + '{' + query + '}\n' + 'JSON:\n', 'json').replace('```json', '').replace('```', '')) 
-        elif model == 'qwen': query_json = json.loads(qwen_llm.generate("You are JSON generator so only generate JSON" + query_to_json_prompt + '{' + query + '}\n' + 'JSON:\n').replace('```json', '').replace('```', ''))
-        elif model == 'phi': query_json = json.loads(phi_llm.generate("You are JSON generator so only generate JSON" + query_to_json_prompt + '{' + query + '}\n' + 'JSON:\n').replace('```json', '').replace('```', ''))
+        elif model == 'qwen': query_json = json.loads(qwen_llm.generate("You are JSON generator so only generate JSON" + query_to_json_prompt + '{' + query + '}\n' + 'JSON:\n', prefix = "You are JSON generator so only generate JSON" + query_to_json_prompt, fence = True).replace('```json', '').replace('```', ''))
+        elif model == 'phi': query_json = json.loads(phi_llm.generate("You are JSON generator so only generate JSON" + query_to_json_prompt + '{' + query + '}\n' + 'JSON:\n', prefix = "You are JSON generator so only generate JSON" + query_to_json_prompt, fence = True).replace('```json', '').replace('```', ''))
         else: ...
         
         with open(path+'plans/' + 'query.txt', 'w') as f:
@@ -259,12 +391,15 @@ def pipeline(query, mode, model, index, model_version = None):
         f.close()
 
         print('-----------------query in json format-----------------\n',query_json)
+        if prune:
+            for search in [FlightSearch, AccommodationSearch, RestaurantSearch]:
+                search.set_pruning(query_json)
         start = time.time()
         if model == 'gpt': steps = GPT_response(constraint_to_step_prompt + query + '\n' + 'Steps:\n', model_version)
         elif model == 'claude': steps = Claude_response(constraint_to_step_prompt + query + '\n' + 'Steps:\n')
         elif model == 'mixtral': steps = Mixtral_response(constraint_to_step_prompt + query + '\n' + 'Steps:\n')
-        elif model == 'qwen': steps = qwen_llm.generate(constraint_to_step_prompt + query + '\n' + 'Steps:\n')
-        elif model == 'phi': steps = phi_llm.generate(constraint_to_step_prompt + query + '\n' + 'Steps:\n')
+        elif model == 'qwen': steps = qwen_llm.generate(constraint_to_step_prompt + query + '\n' + 'Steps:\n', prefix = constraint_to_step_prompt)
+        elif model == 'phi': steps = phi_llm.generate(constraint_to_step_prompt + query + '\n' + 'Steps:\n', prefix = constraint_to_step_prompt)
         else: ...
         json_step = time.time()
         times.append(json_step - start)
@@ -275,6 +410,7 @@ def pipeline(query, mode, model, index, model_version = None):
 
         steps = steps.split('\n\n')
         # pdb.set_trace()
+        step_prompts = []
         for step in steps:
             print('!!!!!!!!!!STEP!!!!!!!!!!\n', step, '\n')
             try: 
@@ -290,61 +426,104 @@ def pipeline(query, mode, model, index, model_version = None):
                     step_key = key
 
             print(prompt +'\nRespond with python codes only, do not add \ in front of symbols like _ or *.\n Follow the indentation of provided examples carefully, indent after for-loops!\n' +lines)
-                    
-            start = time.time()
-            if model == 'gpt': code = GPT_response(prompt + lines, model_version)
-            elif model == 'claude': code = Claude_response(prompt + lines)
-            elif model == 'mixtral': code = Mixtral_response(prompt +'\nRespond with python codes only, do not add \ in front of symbols like _ or *.\n Follow the indentation of provided examples carefully, indent after for-loops!\n' +lines, 'code') # '\nRespond json with python codes only\n' 
-            elif model == 'qwen': code = qwen_llm.generate(prompt +'\nRespond with python codes only, do not add \ in front of symbols like _ or *.\n Follow the indentation of provided examples carefully, indent after for-loops!\n' +lines) # '\nRespond json with python codes only\n'
-            elif model == 'phi': code = phi_llm.generate(prompt +'\nRespond with python codes only, do not add \ in front of symbols like _ or *.\n Follow the indentation of provided examples carefully, indent after for-loops!\n' +lines) # '\nRespond json with python codes only\n'
+            step_prompts.append((step_key, prompt, lines))
+
+        # the step prompts end their answers with '########## <step> response ends##########'; local models stop there
+        # or at the fence closing the code, whichever comes first
+        code_stops = ['response ends##########']
+
+        def request_step_code(prompt, lines):
+            if model == 'gpt': return GPT_response(prompt + lines, model_version)
+            elif model == 'claude': return Claude_response(prompt + lines)
+            elif model == 'mixtral': return Mixtral_response(prompt +'\nRespond with python codes only, do not add \ in front of symbols like _ or *.\n Follow the indentation of provided examples carefully, indent after for-loops!\n' +lines, 'code') # '\nRespond json with python codes only\n' 
+            elif model == 'qwen': return qwen_llm.generate(prompt +'\nRespond with python codes only, do not add \ in front of symbols like _ or *.\n Follow the indentation of provided examples carefully, indent after for-loops!\n' +lines, prefix = prompt +'\nRespond with python codes only, do not add \ in front of symbols like _ or *.\n Follow the indentation of provided examples carefully, indent after for-loops!\n', stop = code_stops, fence = True) # '\nRespond json with python codes only\n'
+            elif model == 'phi': return phi_llm.generate(prompt +'\nRespond with python codes only, do not add \ in front of symbols like _ or *.\n Follow the indentation of provided examples carefully, indent after for-loops!\n' +lines, prefix = prompt +'\nRespond with python codes only, do not add \ in front of symbols like _ or *.\n Follow the indentation of provided examples carefully, indent after for-loops!\n', stop = code_stops, fence = True) # '\nRespond json with python codes only\n'
             else: ...
 
+        def generate_step_code(step_prompt):
+            step_key, prompt, lines = step_prompt
+            start = time.time()
+            if step_cache:
+                code = templated_step_code([model, model_version], prompt, lines, query_json, lambda lines: request_step_code(prompt, lines))
+            else:
+                code = request_step_code(prompt, lines)
+            return code, time.time() - start
+
+        # each step's code only depends on the steps text, so the requests are issued concurrently and
+        # their answers used in step order; local models answer all the steps in batched forward passes, or one
+        # step at a time, resuming from the cached prompt prefixes, when codes are looked up by step template
+        if model in ['qwen', 'phi'] and not step_cache:
+            local_llm = qwen_llm if model == 'qwen' else phi_llm
+            start = time.time()
+            step_codes_batch = local_llm.generate_batch([prompt +'\nRespond with python codes only, do not add \ in front of symbols like _ or *.\n Follow the indentation of provided examples carefully, indent after for-loops!\n' +lines for step_key, prompt, lines in step_prompts],
+                                                      stop = code_stops, fence = True)
+            # the batch time is shared out evenly over its steps
+            seconds = (time.time() - start) / max(1, len(step_prompts))
+            step_responses = [(code, seconds) for code in step_codes_batch]
+        else:
+            concurrency = max_concurrency if model in ['gpt', 'claude', 'mixtral'] else 1
+            with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+                step_responses = list(executor.map(generate_step_code, step_prompts))
+        for (step_key, prompt, lines), (code, seconds) in zip(step_prompts, step_responses):
             print(code)
-            step_code = time.time()
-            times.append(step_code - start)
+            times.append(seconds)
             code = code.replace('```python', '')
             code = code.replace('```', '')
             code = code.replace('\_', '_')
 
+            step_codes.append((step_key, code))
             if step_key != 'Destination cities': 
-                if query_json['days'] == 3:
-                    code = code.replace('\n', '\n    ')
-                elif query_json['days'] == 5:
-                    code = code.replace('\n', '\n            ')
-                else:
-                    code = code.replace('\n', '\n                ')
+                code = indent_step_code(code, query_json['days'])
             print('!!!!!!!!!!CODE!!!!!!!!!!\n', code, '\n')
             codes += code + '\n'
             with open(path+'codes/' + f'{step_key}.txt', 'w') as f:
                 f.write(code)
             f.close()
-        with open('prompts/solve_{}.txt'.format(query_json['days']), 'r') as f:
-            codes += f.read()
+        program = SolverProgram(assemble_segments(step_codes, query_json['days'], incremental), timed = True)
+        codes = program.source
         start = time.time()
-        exec(codes)
+        solved = solve_in_parallel(step_codes, query_json['days'], locals(), workers, incremental) if workers > 1 else None
+        if solved is None:
+            local_vars = locals()
+            program.run(globals(), local_vars)
+            # seconds from the start of each step to the start of the next one, summed over the city loops
+            with open(path+'plans/' + 'step_time.json', 'w') as f:
+                json.dump(program.times, f)
+            f.close()
         exec_code = time.time()
         times.append(exec_code - start)
     except Exception as e:
-        with open(path+'codes/' + 'codes.txt', 'w') as f:
-            f.write(codes)
-        f.close()
         with open(path+'plans/' + 'error.txt', 'w') as f:
             f.write(str(e))
             # f.write(e.args)
         f.close()
+    # the solver code is kept on every run, with the tool modes it was built for, so that --replay can rerun it
+    with open(path+'codes/' + 'codes.txt', 'w') as f:
+        f.write(codes)
+    f.close()
+    with open(path+'codes/' + 'modes.json', 'w') as f:
+        json.dump({'encoding': encoding, 'prune': prune}, f)
+    f.close()
     with open(path+'plans/' + 'time.txt', 'w') as f:
         for line in times:
             f.write(f"{line}\n")
     
-def run_code(mode, user_mode, index):
+def run_code(mode, user_mode, index, encoding = 'array', prune = False):
     path =  f'output/{mode}/{user_mode}/{index}/'
+    # the tool modes the code was saved with; code saved without them runs with the given ones
+    if os.path.exists(path+'codes/' + 'modes.json'):
+        with open(path+'codes/' + 'modes.json', 'r') as f:
+            modes = json.load(f)
+        f.close()
+        encoding, prune = modes['encoding'], modes['prune']
         
     CitySearch = Cities()
-    FlightSearch = Flights()
+    FlightSearch = Flights(encoding=encoding)
     AttractionSearch = Attractions()
     DistanceSearch = GoogleDistanceMatrix()
-    AccommodationSearch = Accommodations()
-    RestaurantSearch = Restaurants()
+    AccommodationSearch = Accommodations(encoding=encoding)
+    RestaurantSearch = Restaurants(encoding=encoding)
+    searches = {'FlightSearch': FlightSearch, 'AttractionSearch': AttractionSearch, 'DistanceSearch': DistanceSearch, 'AccommodationSearch': AccommodationSearch, 'RestaurantSearch': RestaurantSearch}
     s = Optimize()
     variables = {}
     success = False
@@ -355,20 +534,73 @@ def run_code(mode, user_mode, index):
     with open(path+'codes/' + 'codes.txt', 'r') as f:
         codes = f.read()
     f.close()
+    if prune:
+        for search in [FlightSearch, AccommodationSearch, RestaurantSearch]:
+            search.set_pruning(query_json)
     local_vars = locals()
     start = time.time()
-    exec(codes, globals(), local_vars)
+    SolverProgram([('codes', codes)]).run(globals(), local_vars)
     exec_code = time.time()
     print('time', exec_code - start)
 
+def init_llm_budget(semaphore = None, next_slot = None, requests_per_minute = None):
+    """Hand the shared LLM request budget to openai_func (see set_llm_budget), importing it only when a budget is set."""
+    if semaphore is None and next_slot is None:
+        return
+    from openai_func import set_llm_budget
+    set_llm_budget(semaphore, next_slot, requests_per_minute)
+
+def run_queries(queries, mode, model, model_version, processes, options, budget = (None, None, None)):
+    """
+    Run pipeline on every (index, query) pair in `queries` with up to `processes` queries at a time.
+    With API models each query gets a fresh process, so the exec'd solver code of one query never shares
+    state with another; local models keep their processes, which would otherwise reload the model weights
+    for every query. Every process draws its LLM requests from the same `budget` (see set_llm_budget).
+    """
+    context = multiprocessing.get_context('spawn')
+    max_tasks_per_child = 1 if model in ['gpt', 'claude', 'mixtral'] else None
+    with ProcessPoolExecutor(max_workers=processes, mp_context=context, max_tasks_per_child=max_tasks_per_child, initializer=init_llm_budget, initargs=budget) as executor:
+        futures = {executor.submit(pipeline, query, mode, model, index, model_version, **options): index for index, query in queries}
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            try:
+                future.result()
+            except Exception as e:
+                print(f'Query {futures[future]} failed: {e}')
+
 if __name__ == '__main__':
 
     tools_list = ["flights","attractions","accommodations","restaurants","googleDistanceMatrix","cities"]
     parser = argparse.ArgumentParser()
     parser.add_argument("--set_type", type=str, default="validation")
     parser.add_argument("--model_name", type=str, default="gpt") #'gpt', 'claude', 'mixtral'
+    parser.add_argument("--encoding", type=str, default="array", choices=["array", "flat"]) # Z3 encoding of the flight, accommodation and restaurant candidates
+    parser.add_argument("--prune", action="store_true") # drop dominated flight, accommodation and restaurant candidates before encoding
+    parser.add_argument("--incremental", action="store_true") # reuse one solver across destination city combinations with push/pop
+    parser.add_argument("--workers", type=int, default=1) # processes that split the destination city combinations, the first plan found wins
+    parser.add_argument("--max_concurrency", type=int, default=8) # step-to-code requests sent to the LLM API at the same time
+    parser.add_argument("--processes", type=int, default=1) # queries run in parallel, one process each
+    parser.add_argument("--llm_concurrency", type=int, default=None) # LLM API requests in flight across all processes
+    parser.add_argument("--requests_per_minute", type=float, default=None) # LLM API requests started per minute across all processes
+    parser.add_argument("--step_cache", action="store_true") # reuse the code of steps that only differ in cities, dates and budget from earlier queries
+    parser.add_argument("--quantize", type=str, default=None, choices=["int8", "int4"]) # CPU weight quantization of the local models (qwen, phi)
+    parser.add_argument("--threads", type=int, default=None) # torch threads of the local models on CPU
+    parser.add_argument("--max_memory_gb", type=float, default=None) # refuse to load a local model whose estimated peak memory is above this
+    parser.add_argument("--replay", type=int, nargs="+", default=None) # rerun the saved codes.txt of these query numbers without any LLM or dataset import
     args = parser.parse_args()
 
+    if args.replay:
+        startup = time.perf_counter() - _import_start
+        print('startup', startup)
+        imported = [module for module in REPLAY_UNUSED_MODULES if module in sys.modules]
+        assert len(imported) == 0, f'--replay imported {imported}'
+        assert startup < REPLAY_STARTUP_SECONDS, f'--replay took {startup:.2f} s to start, over REPLAY_STARTUP_SECONDS={REPLAY_STARTUP_SECONDS}'
+        for number in args.replay:
+            print(number)
+            run_code(args.set_type, args.model_name + '_nl', number, args.encoding, args.prune)
+        sys.exit(0)
+
+    from datasets import load_dataset
+
     if args.set_type == 'validation':
         print('validation')
         query_data_list  = load_dataset('osunlp/TravelPlanner','validation')['validation']
@@ -379,12 +611,25 @@ if __name__ == '__main__':
         query_data_list  = load_dataset('osunlp/TravelPlanner','train')['train']
 
     numbers = [i for i in range(1,len(query_data_list)+1)]
-    with get_openai_callback() as cb:
-        
-        for number in tqdm(numbers[:]):
-            path =  f'output/{args.set_type}/{args.model_name}/{number}/plans/'
-            if not os.path.exists(path + 'plan.txt'):
+    # resume: skip the queries an earlier run already took to the end
+    numbers = [number for number in numbers if not query_finished(args.set_type, args.model_name, number)]
+    options = dict(encoding=args.encoding, prune=args.prune, incremental=args.incremental, workers=args.workers, max_concurrency=args.max_concurrency, step_cache=args.step_cache,
+                   quantize=args.quantize, threads=args.threads, max_memory_gb=args.max_memory_gb)
+    context = multiprocessing.get_context('spawn')
+    budget = (context.BoundedSemaphore(args.llm_concurrency) if args.llm_concurrency else None,
+              context.Value('d', 0.0) if args.requests_per_minute else None,
+              args.requests_per_minute)
+    if args.processes > 1:
+        run_queries([(number, query_data_list[number-1]['query']) for number in numbers], args.set_type, args.model_name, "gpt-4o", args.processes, options, budget)
+    else:
+        init_llm_budget(*budget)
+        from langchain.callbacks import get_openai_callback
+        with get_openai_callback() as cb:
+            
+            for number in tqdm(numbers[:]):
                 print(number)
                 query = query_data_list[number-1]['query']
                 print(query)
-                result_plan = pipeline(query, args.set_type, args.model_name, number, "gpt-4o") #'gpt', 'claude', 'mixtral'
+                result_plan = pipeline(query, args.set_type, args.model_name, number, "gpt-4o", **options) #'gpt', 'claude', 'mixtral'
+    if llm_cache() is not None:
+        print('LLM response cache:', llm_cache().stats())
@@ -3,6 +3,10 @@ import numpy as np
 from pandas import DataFrame
 from typing import Optional
 from utils.func import extract_before_parenthesis
+from utils.database import load_database
+from utils.flat_table import FlatTable, FlatColumn
+from utils.pruning import accommodation_positions
+from utils.interning import first_positions, city_ids, intern_columns
 from z3 import *
 import ast
 
@@ -18,10 +22,49 @@ def extract_integer_price(pricing_string):
 
 
 
+def _load_accommodations(path):
+    df = pd.read_csv(path).dropna()
+    df['price'] = df['pricing'].apply(extract_integer_price)
+    df = df.rename(columns={
+        "name" : "NAME", 
+        "roomType" : "room type",
+        "house_rules" : "house_rules",
+        "max_occupancy" : "maximum occupancy",
+        "City" : "city" 
+    })
+    df['minimum nights'] = 1.0   #Putting a default value as this data is not available in dataset 
+    return df[['NAME','price','room type', 'house_rules', 'minimum nights', 'maximum occupancy', 'rating', 'city']]
+
+_TYPES_RULES = ['private_room', 'entire_home', 'shared_room', 'No visitors', 'No smoking', 'No parties', 'No children under 10', 'No pets']
+
+def _type_rule_masks(data):
+    # bit j is set when _TYPES_RULES[j] appears in the room type (j < 3) or in the house rules (j >= 3)
+    room_types = np.zeros(len(data), dtype=np.int64)
+    house_rules = np.zeros(len(data), dtype=np.int64)
+    for j, name in enumerate(_TYPES_RULES):
+        if j < 3:
+            room_types |= data['room type'].str.contains(name, regex=False).to_numpy(dtype=np.int64) << j
+        else:
+            house_rules |= data['house_rules'].str.contains(name, regex=False).to_numpy(dtype=np.int64) << j
+    return {'room_types': room_types, 'house_rules': house_rules}
+
+
+
+def _intern_accommodations(data):
+    return intern_columns(data, {'city': city_ids})
+
 class Accommodations:
-    def __init__(self, path="TripCraft_database/accommodation/cleaned_listings_final_v2.csv"):
+    def __init__(self, path="TripCraft_database/accommodation/cleaned_listings_final_v2.csv", encoding="array"):
         self.path = path
-        self.data = self.load_db()
+        self.pruning = None
+        # the candidate rows of every city the solver code encoded, and the city list it was given, so that
+        # the model is decoded against the rows its indices refer to
+        self.encoded = {}
+        self.all_cities = None
+        # "array" builds nested Z3 Store terms, "flat" builds FlatTable If-chains over the candidate rows
+        self.encoding = encoding
+        self.data = load_database('TripCraft', 'accommodations', self.path, _load_accommodations, cache=True, prepare=_intern_accommodations)
+        self.masks = load_database('TripCraft', 'accommodations_masks', self.path, lambda path: _type_rule_masks(self.data), cache=True)
         print(self.data.columns)
         print("Accommodations loaded.")
 
@@ -29,17 +72,8 @@ class Accommodations:
 
     def load_db(self):
         """ load database and feature analysis"""
-        df = pd.read_csv(self.path).dropna()
-        df['price'] = df['pricing'].apply(extract_integer_price)
-        df = df.rename(columns={
-            "name" : "NAME", 
-            "roomType" : "room type",
-            "house_rules" : "house_rules",
-            "max_occupancy" : "maximum occupancy",
-            "City" : "city" 
-        })
-        df['minimum nights'] = 1.0   #Putting a default value as this data is not available in dataset 
-        self.data = df[['NAME','price','room type', 'house_rules', 'minimum nights', 'maximum occupancy', 'rating', 'city']]
+        self.data = _intern_accommodations(_load_accommodations(self.path))
+        self.masks = _type_rule_masks(self.data)
         return self.data
 
 
@@ -47,7 +81,7 @@ class Accommodations:
     def run_search(self, city):
         """ Returns unique room types available in the given city """
 
-        results = self.data[self.data["city"] == city]
+        results = self.data[self.data['city'] == city]
         if len(results) == 0:
             return "There is no accommodation in this city."
         
@@ -75,7 +109,7 @@ class Accommodations:
 
     def run(self, city: str ) -> DataFrame:
         """Search for accommodations by city."""
-        results = self.data[self.data["city"] == city]
+        results = self.data[self.data['city'] == city]
         if len(results) == 0:
             return "There is no accomodation in this city."
         
@@ -83,19 +117,64 @@ class Accommodations:
 
 
 
+    def set_pruning(self, query):
+        """Encode only the non-dominated listings for `query` (the query JSON), or every listing when it is None."""
+        self.pruning = query
+        self.encoded = {}
+
+
+
+    def city_positions(self, city_id):
+        """Return the table positions of the listings in the city with interned id `city_id`."""
+        return np.flatnonzero(self.data['city'].cat.codes.to_numpy() == city_id)
+
+
+
+    def candidate_positions(self, city):
+        """Return the table positions of the listings the solver encodes for `city`."""
+        positions = self.city_positions(city_ids.id(city))
+        if self.pruning is None or len(positions) == 0:
+            return positions
+        kept = accommodation_positions(self.data['price'].to_numpy()[positions], self.data['minimum nights'].to_numpy()[positions],
+                                       self.data['maximum occupancy'].to_numpy()[positions], self.masks['room_types'][positions],
+                                       self.masks['house_rules'][positions], self.pruning)
+        return positions[kept]
+
+
+
+    def candidates(self, city):
+        """Return the listings the solver encodes for `city`; model indices refer to these rows."""
+        return self.data.iloc[self.candidate_positions(city)]
+
+
+
+    def encoded_candidates(self, city):
+        """Return the listings encoded for `city`, looking them up only for a city the solver code did not encode."""
+        rows = self.encoded.get(city)
+        if rows is None:
+            return self.candidates(city)
+        return rows
+
+
+
     def run_for_all_cities( self, all_cities: list, cities: list ):
         """
         For each city in `cities`, this function extracts accommodation data and stores it into Z3 Arrays (`results` and `results_hard_constraint`). 
 
         - `results` keeps numeric attributes: price, minimum nights, maximum occupancy, and the number of listings (length).
-        - `results_hard_constraint` keeps boolean attributes for room types and house rules. 
+        - `results_hard_constraint` keeps 8-bit masks of the room types and house rules, one bit per entry of _TYPES_RULES. 
         """
-        types_rule_list = ['private_room', 'entire_home', 'shared_room', 'No visitors', 'No smoking', 'No parties', 'No children under 10', 'No pets']
+        self.all_cities = list(all_cities)
+        if self.encoding == 'flat':
+            return self.run_for_all_cities_flat(all_cities, cities)
+        city_index = first_positions(all_cities)
         results = Array('accommodations', IntSort(), IntSort(), ArraySort(IntSort(), IntSort())) # (city index, attribute index) → values for price, minimum_nights, maximum_occupancy, length
-        results_hard_constraint = Array('accommodations hard constraint', IntSort(), IntSort(), ArraySort(IntSort(), IntSort(), BoolSort())) # (city index, attribute index) → boolean arrays for room types and house rules
+        results_hard_constraint = Array('accommodations hard constraint', IntSort(), IntSort(), ArraySort(IntSort(), BitVecSort(8))) # (city index, attribute index) → bitmask arrays for room types and house rules
         
         for i, city in enumerate(cities):
-            result = self.data[self.data["city"] == city]
+            positions = self.candidate_positions(city)
+            result = self.data.iloc[positions]
+            self.encoded[city] = result
             
             if len(result) != 0:
                 # print('accommodations',city, len(result), len(np.array(result)[:,1]), np.array(result)[:,2], np.array(result)[:,3])
@@ -104,56 +183,79 @@ class Accommodations:
                 price = Array('Price', IntSort(), IntSort())
                 minimum_nights = Array('Minimum_nights', IntSort(), IntSort())
                 maximum_occupancy = Array('Maximum_occupancy', IntSort(), IntSort())
-                room_types = Array('Room_types', IntSort(), IntSort(), BoolSort())
-                house_rules = Array('House_rules', IntSort(), IntSort(), BoolSort())
+                room_types = Array('Room_types', IntSort(), BitVecSort(8))
+                house_rules = Array('House_rules', IntSort(), BitVecSort(8))
+                room_types_masks = self.masks['room_types'][positions]
+                house_rules_masks = self.masks['house_rules'][positions]
                 length = Array('Length', IntSort(), IntSort())
-                length = Store(length, 0, len(np.array(result)[:,1]))
+                rows = np.array(result)
+                length = Store(length, 0, len(rows[:,1]))
                 # import pdb; pdb.set_trace()
 
-                for index in range(np.array(result).shape[0]):
-                    if np.array(result)[:,1][index] is not np.nan:
-                        price = Store(price, index, np.array(result)[:,1][index])
+                for index in range(rows.shape[0]):
+                    if rows[:,1][index] is not np.nan:
+                        price = Store(price, index, rows[:,1][index])
                     else:
                         price = 0 #TODO
                     
-                    if np.array(result)[:,4][index] is not np.nan:
-                        minimum_nights = Store(minimum_nights, index, np.array(result)[:,4][index])
+                    if rows[:,4][index] is not np.nan:
+                        minimum_nights = Store(minimum_nights, index, rows[:,4][index])
                     else:
                         minimum_nights = Store(minimum_nights, index, 0)
                     
-                    if np.array(result)[:,5][index] is not np.nan:
-                        maximum_occupancy = Store(maximum_occupancy, index, np.array(result)[:,5][index])
+                    if rows[:,5][index] is not np.nan:
+                        maximum_occupancy = Store(maximum_occupancy, index, rows[:,5][index])
                     else:
                         maximum_occupancy = 10 #TODO
                     
-                    room_types_list = np.array(result)[:,2][index]
-                    house_rules_list = np.array(result)[:,3][index]
-                    # print(room_types_list)
-                    # print(house_rules_list)
-                    for j in range(3):
-                        # print(types_rule_list[j] in room_types_list)
-                        room_types = Store(room_types, index, j, types_rule_list[j] in room_types_list)
-                    for j in range(3,8):
-                        house_rules = Store(house_rules, index, j, types_rule_list[j] in house_rules_list)
+                    room_types = Store(room_types, index, BitVecVal(int(room_types_masks[index]), 8))
+                    house_rules = Store(house_rules, index, BitVecVal(int(house_rules_masks[index]), 8))
                 
-                results = Store(results, all_cities.index(city), 0, price)
-                results = Store(results, all_cities.index(city), 1, minimum_nights)
-                results = Store(results, all_cities.index(city), 2, maximum_occupancy)
-                results = Store(results, all_cities.index(city), 3, length)
-                results_hard_constraint = Store(results_hard_constraint, all_cities.index(city), 0, room_types)
-                results_hard_constraint = Store(results_hard_constraint, all_cities.index(city), 1, house_rules)
+                results = Store(results, city_index[city], 0, price)
+                results = Store(results, city_index[city], 1, minimum_nights)
+                results = Store(results, city_index[city], 2, maximum_occupancy)
+                results = Store(results, city_index[city], 3, length)
+                results_hard_constraint = Store(results_hard_constraint, city_index[city], 0, room_types)
+                results_hard_constraint = Store(results_hard_constraint, city_index[city], 1, house_rules)
             
             else:
                 length = Array('Length', IntSort(), IntSort())
                 length = Store(length, 0, -1)
-                results = Store(results, all_cities.index(city), 3, length)
+                results = Store(results, city_index[city], 3, length)
         return results, results_hard_constraint
 
 
 
+    def run_for_all_cities_flat(self, all_cities: list, cities: list):
+        """Flat counterpart of run_for_all_cities: one FlatTable holding both the info and the hard constraint columns."""
+        city_index = first_positions(all_cities)
+        table = FlatTable('accommodations', {'Price': IntSort(), 'Minimum_nights': IntSort(), 'Maximum_occupancy': IntSort(), 'Length': IntSort(),
+                                             'Room_types': BitVecSort(8), 'House_rules': BitVecSort(8)})
+        for city in cities:
+            positions = self.candidate_positions(city)
+            if len(positions) == 0:
+                table.add((city_index[city],), Length=[-1])
+                continue
+            result = self.data.iloc[positions]
+            self.encoded[city] = result
+            table.add((city_index[city],),
+                      Price=result['price'].tolist(),
+                      Minimum_nights=result['minimum nights'].tolist(),
+                      Maximum_occupancy=result['maximum occupancy'].tolist(),
+                      Length=[len(positions)],
+                      Room_types=self.masks['room_types'][positions].tolist(),
+                      House_rules=self.masks['house_rules'][positions].tolist())
+        return table, table
+
+
+
     # ['Price', 'Minimum_nights', 'Maximum_occupancy', 'Length']
     def get_info(self, info, i, key):
         """ Retrieve a specific piece of accommodation data from the Z3 Array { Array('accommodations', IntSort(), IntSort(), ArraySort(IntSort(), IntSort())) }. """
+        if isinstance(info, FlatTable):
+            if key == 'Room_types' or key == 'House_rules':
+                return info.column((i,), key), None
+            return info.column((i,), key), info.length((i,))
         if key == 'Room_types' or key == 'House_rules':
             if key == 'Room_types':
                 info_key = Select(info, i, 0)
@@ -171,6 +273,8 @@ class Accommodations:
 
     def get_info_for_index(self, info_list, index):
         """ Return the value from a Z3 Array { ArraySort(IntSort(), IntSort()) } at the given index.  """
+        if isinstance(info_list, FlatColumn):
+            return info_list.select(index)
         return Select(info_list, index)
 
 
@@ -181,13 +285,17 @@ class Accommodations:
         elif type == 'Entire home/apt': type = 'entire_home'
         elif type == 'Private room': type = 'private_room'
 
-        types_rule_list = ['private_room', 'entire_home', 'shared_room', 'No visitors', 'No smoking', 'No parties', 'No children under 10', 'No pets']
-        exists = Select(accommodation_list, index, types_rule_list.index(type))
+        # room types and house rules are bitmasks, with the bit of each name at its position in _TYPES_RULES
+        bit = _TYPES_RULES.index(type)
+        if isinstance(accommodation_list, FlatColumn):
+            exists = accommodation_list.any(lambda mask: mask >> bit & 1, index)
+        else:
+            exists = Extract(bit, bit, Select(accommodation_list, index)) == 1
         return If(index != -1, exists, BoolVal(False))
 
 
 
     def run_for_annotation(self, city: str ) -> DataFrame:
         """Search for accommodations by city."""
-        results = self.data[self.data["city"] == extract_before_parenthesis(city)]
+        results = self.data[self.data['city'] == extract_before_parenthesis(city)]
         return results
\ No newline at end of file
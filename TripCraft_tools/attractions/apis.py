@@ -3,35 +3,48 @@ import numpy as np
 from pandas import DataFrame
 from typing import Optional
 from utils.func import extract_before_parenthesis
+from utils.database import load_database
+from utils.interning import first_positions, city_ids, intern_columns
 from z3 import *
 
 
+def _load_attractions(path):
+    df = pd.read_csv(path).dropna()
+    df = df.rename(columns={
+        "name" : "Name", 
+        "latitude" : "Latitude",
+        "longitude" : "Longitude",
+        "address" : "Address",
+        "website" : "Website"
+    })
+    df['Phone'] = 00            #Putting a default value as this data is not available in dataset
+    return df[['Name','Latitude','Longitude','Address','Phone','Website',"City"]]
+
+
+def _intern_attractions(data):
+    return intern_columns(data, {'City': city_ids})
+
 class Attractions:
     def __init__(self, path='TripCraft_database/attraction/cleaned_attractions_final.csv'):
         self.path = path
-        self.data = self.load_db()
+        # the candidate rows of every city the solver code encoded, and the city list it was given, so that
+        # the model is decoded against the rows its indices refer to
+        self.encoded = {}
+        self.all_cities = None
+        self.data = load_database('TripCraft', 'attractions', self.path, _load_attractions, cache=True, prepare=_intern_attractions)
         print(self.data.columns)
         print("Attractions loaded.")
 
     def load_db(self):
         """ load database and feature analysis"""
-        df = pd.read_csv(self.path).dropna()
-        df = df.rename(columns={
-            "name" : "Name", 
-            "latitude" : "Latitude",
-            "longitude" : "Longitude",
-            "address" : "Address",
-            "website" : "Website"
-        })
-        df['Phone'] = 00            #Putting a default value as this data is not available in dataset
-        self.data = df[['Name','Latitude','Longitude','Address','Phone','Website',"City"]]
+        self.data = _intern_attractions(_load_attractions(self.path))
         return self.data
 
 
 
     def run(self, city: str ) -> DataFrame:
         """Search for Accommodations by city and date."""
-        results = self.data[self.data["City"] == city]
+        results = self.data[self.data['City'] == city]
         # the results should show the index
         results = results.reset_index(drop=True)
         if len(results) == 0:
@@ -40,16 +53,28 @@ class Attractions:
 
 
 
+    def encoded_candidates(self, city):
+        """Return the attractions encoded for `city`, looking them up only for a city the solver code did not encode."""
+        rows = self.encoded.get(city)
+        if rows is None:
+            return self.data[self.data['City'] == city]
+        return rows
+
+
+
     def run_for_all_cities(self, all_cities, cities: list ):
         """Builds a Z3 array mapping each city's index in all_cities to the number of attractions found in self.data (or -1 if no data)."""
+        self.all_cities = list(all_cities)
+        city_index = first_positions(all_cities)
         results = Array('attractions', IntSort(), IntSort()) 
         for i, city in enumerate(cities):
-            result = self.data[self.data["City"] == city]
+            result = self.data[self.data['City'] == city]
+            self.encoded[city] = result
             if len(result) != 0:
                 # print('attraction', city, len(result), len(np.array(result)[:,1]))
-                results = Store(results, all_cities.index(city), IntVal(len(np.array(result)[:,1])))
+                results = Store(results, city_index[city], IntVal(len(np.array(result)[:,1])))
             else:
-                results = Store(results, all_cities.index(city), -1)
+                results = Store(results, city_index[city], -1)
         return results
 
 
@@ -98,7 +123,7 @@ class Attractions:
             city: str,
             ) -> DataFrame:
         """Search for Accommodations by city and date."""
-        results = self.data[self.data["City"] == extract_before_parenthesis(city)]
+        results = self.data[self.data['City'] == extract_before_parenthesis(city)]
         # the results should show the index
         results = results.reset_index(drop=True)
         return results
\ No newline at end of file
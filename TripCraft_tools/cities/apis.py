@@ -3,22 +3,58 @@ from TripCraft_tools.accommodations.apis import *
 from TripCraft_tools.restaurants.apis import *
 from TripCraft_tools.googleDistanceMatrix.apis import *
 from TripCraft_tools.flights.apis import *
+from TripCraft_tools.flights.apis import _load_flights, _intern_flights
+from TripCraft_tools.googleDistanceMatrix.apis import _intern_distances
+from TripCraft_tools.googleDistanceMatrix.apis import extract_before_parenthesis
+from utils.database import load_database
+import pandas as pd
+
+def _load_city_states(path):
+    cityStateMapping = open(path, "r").read().strip().split("\n")
+    data = {}
+    for unit in cityStateMapping:
+        city, state = unit.split("\t")
+        if state not in data:
+            data[state] = [city]
+        else:
+            data[state].append(city)
+    return data
+
+def _index_flight_routes(data):
+    # the destinations served from every (origin, date)
+    return {key: set(destinations) for key, destinations in data.groupby(['OriginCityName', 'FlightDate'], sort=False, observed=True)['DestCityName'].unique().items()}
+
+def _index_drivable(data):
+    # per origin, the destinations whose distance row (the first one) has a duration and a distance and
+    # takes at most a day
+    first = data.drop_duplicates(['origin', 'destination'])
+    valid = first['duration_min'].notna() & first['distance_km'].notna()
+    valid &= first['duration_min'].where(valid, 0).astype(int) <= 1440
+    index = {}
+    for origin, destination in zip(first['origin'][valid], first['destination'][valid]):
+        index.setdefault(origin, set()).add(destination)
+    return index
 
 class Cities:
-    def __init__(self ,path="TripCraft_database/background/citySet_with_states_140.txt") -> None:
+    def __init__(self ,path="TripCraft_database/background/citySet_with_states_140.txt", flights_path="TripCraft_database/flights/cleaned_flights_november_2024.csv", distance_path="TripCraft_database/distance_matrix/city_distances_times_full.csv") -> None:
         self.path = path
+        self.flights_path = flights_path
+        self.distance_path = distance_path
+        # reachability indexes over the flight and distance tables, loaded by the first run
+        self.flight_routes = None
+        self.drivable = None
         self.load_data()
         print("Cities loaded.")
 
     def load_data(self):
-        cityStateMapping = open(self.path, "r").read().strip().split("\n")
-        self.data = {}
-        for unit in cityStateMapping:
-            city, state = unit.split("\t")
-            if state not in self.data:
-                self.data[state] = [city]
-            else:
-                self.data[state].append(city)
+        self.data = load_database('TripCraft', 'cities', self.path, _load_city_states)
+
+    def load_reachability(self):
+        """Load the indexes run checks flight and driving reachability against, shared by the whole process."""
+        self.flight_routes = load_database('TripCraft', 'flight_routes', self.flights_path,
+                                           lambda path: _index_flight_routes(load_database('TripCraft', 'flights', path, _load_flights, cache=True, prepare=_intern_flights)), cache=True)
+        self.drivable = load_database('TripCraft', 'drivable', self.distance_path,
+                                      lambda path: _index_drivable(load_database('TripCraft', 'distance', path, pd.read_csv, cache=True, prepare=_intern_distances)), cache=True)
     
     def run(self, state, origin, dates) -> dict:
         if state not in self.data:
@@ -27,16 +63,14 @@ class Cities:
         else:
             city_list = self.data[state]
             # print(city_list)
-            AccommodationSearch = Accommodations()
-            RestaurantSearch = Restaurants()
-            FlightSearch = Flights()
-            DistanceSearch = GoogleDistanceMatrix()
+            if self.flight_routes is None:
+                self.load_reachability()
+            flights = self.flight_routes.get((origin, dates[0]), set())
+            drivable = self.drivable.get(extract_before_parenthesis(origin), set())
             good = []
             bad = []
             for city in city_list:
-                flight = FlightSearch.run(origin, city, dates[0])
-                drive = DistanceSearch.run(origin, city)
-                if not 'no flight' in flight or not 'No valid information' in drive:
+                if city in flights or extract_before_parenthesis(city) in drivable:
                     good.append(city)
                 else:
                     bad.append(city)
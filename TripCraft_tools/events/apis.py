@@ -2,21 +2,26 @@ import pandas as pd
 from pandas import DataFrame
 from typing import Optional
 # from utils.func import extract_before_parenthesis
+from utils.database import load_database
 from datetime import datetime
 
+def _load_events(path):
+    # Read CSV and preprocess dates
+    data = pd.read_csv(path)[['name', 'url', 'dateTitle', 'streetAddress', 'segmentName', 'city']].dropna(
+        subset=['name', 'url', 'dateTitle', 'streetAddress', 'segmentName', 'city']
+    )
+
+    # Keep only rows with valid date formats (dd-mm-yyyy)
+    data = data[data['dateTitle'].str.match(r'^\d{2}-\d{2}-\d{4}$', na=False)]
+
+    # Convert date format in the CSV to datetime for filtering
+    data['dateTitle'] = pd.to_datetime(data['dateTitle'], format='%d-%m-%Y')
+    return data
+
 class Events:
     def __init__(self, path='D:\\BTP\\Tripcraft\\ATP_database\\events\\events_cleaned.csv'):
         self.path = path
-        # Read CSV and preprocess dates
-        self.data = pd.read_csv(self.path)[['name', 'url', 'dateTitle', 'streetAddress', 'segmentName', 'city']].dropna(
-            subset=['name', 'url', 'dateTitle', 'streetAddress', 'segmentName', 'city']
-        )
-
-        # Keep only rows with valid date formats (dd-mm-yyyy)
-        self.data = self.data[self.data['dateTitle'].str.match(r'^\d{2}-\d{2}-\d{4}$', na=False)]
-
-        # Convert date format in the CSV to datetime for filtering
-        self.data['dateTitle'] = pd.to_datetime(self.data['dateTitle'], format='%d-%m-%Y')
+        self.data = load_database('TripCraft', 'events', self.path, _load_events, cache=True)
         print("Events loaded.")
 
     def load_db(self):
@@ -3,15 +3,53 @@ import numpy as np
 from pandas import DataFrame
 from typing import Optional
 from utils.func import extract_before_parenthesis
+from utils.database import load_database, MMAP_FLIGHTS
+from utils.legs import city_legs
+from utils.flight_table import FlightTable
+from utils.flat_table import FlatTable, FlatColumn
+from utils.pruning import flight_positions
+from utils.interning import first_positions, city_ids, date_ids, intern_columns
 from z3 import *
 import copy
 
+def _load_flights(path):
+    return pd.read_csv(path).dropna()[['Flight Number', 'Price', 'DepTime', 'ArrTime', 'ActualElapsedTime','FlightDate','OriginCityName','DestCityName','Distance']]
+
+def _convert_time(times):
+    output = []
+    for time in times:
+        hour = time.split(':')[0]
+        minute = time.split(':')[1]
+        time_float = int(hour) + float(minute)/60
+        output.append(time_float)
+    return output
+
+def _index_flights(data):
+    # row positions of every (origin, destination, date) triple, in table order
+    return data.groupby(['OriginCityName', 'DestCityName', 'FlightDate'], sort=False, observed=True).indices
+
+def _intern_flights(data):
+    return intern_columns(data, {'OriginCityName': city_ids, 'DestCityName': city_ids, 'FlightDate': date_ids})
+
 class Flights:
 
-    def __init__(self, path="TripCraft_database/flights/cleaned_flights_november_2024.csv"):
+    def __init__(self, path="TripCraft_database/flights/cleaned_flights_november_2024.csv", mmap=None, encoding="array"):
         self.path = path
+        # "array" builds nested Z3 Store terms, "flat" builds FlatTable If-chains over the candidate rows
+        self.encoding = encoding
         self.data = None
-        self.data = pd.read_csv(self.path).dropna()[['Flight Number', 'Price', 'DepTime', 'ArrTime', 'ActualElapsedTime','FlightDate','OriginCityName','DestCityName','Distance']]
+        self.table = None
+        self.pruning = None
+        # the candidate rows of every leg the solver code encoded, and the city list it was given, so that
+        # the model is decoded against the rows its indices refer to
+        self.encoded = {}
+        self.all_cities = None
+        # mmap mode serves lookups from a FlightTable shared between processes instead of a pandas copy
+        if MMAP_FLIGHTS if mmap is None else mmap:
+            self.table = FlightTable('TripCraft', self.path, _load_flights)
+        else:
+            self.data = load_database('TripCraft', 'flights', self.path, _load_flights, cache=True, prepare=_intern_flights)
+            self.index = load_database('TripCraft', 'flights_index', self.path, lambda path: _index_flights(self.data), cache=True)
         print("Flights API loaded.")
         List = Datatype('List')
         
@@ -28,15 +66,24 @@ class Flights:
 
     def load_db(self):
         """ load the flight dataset """
-        self.data = pd.read_csv(self.path).dropna().rename(columns={'Unnamed: 0': 'Flight Number'})
+        self.data = _intern_flights(pd.read_csv(self.path).dropna().rename(columns={'Unnamed: 0': 'Flight Number'}))
+        self.index = _index_flights(self.data)
+        self.table = None
+
+    def lookup(self, origin, destination, departure_date):
+        """Return the rows of flights from origin to destination on departure date, in table order."""
+        if self.table is not None:
+            return self.table.lookup(origin, destination, departure_date)
+        rows = self.index.get((origin, destination, departure_date))
+        if rows is None:
+            return self.data.iloc[:0]
+        return self.data.iloc[rows]
 
 
 
     def run_check(self, origin, destination, departure_date):
         """ Check if a flight exists between origin and destination on a specific date """
-        results = self.data[self.data["OriginCityName"] == origin]
-        results = results[results["DestCityName"] == destination]
-        results = results[results["FlightDate"] == departure_date]
+        results = self.lookup(origin, destination, departure_date)
         if len(results) == 0:
             return "There is no flight from {} to {} on {}.".format(origin, destination, departure_date)
         else:
@@ -44,10 +91,47 @@ class Flights:
 
 
 
+    def set_pruning(self, query):
+        """Encode only the non-dominated flights for `query` (the query JSON), or every flight when it is None."""
+        self.pruning = query
+        self.encoded = {}
+
+    def candidates(self, origin, destination, departure_date):
+        """Return the flights the solver encodes for one route and date; model indices refer to these rows."""
+        results = self.lookup(origin, destination, departure_date)
+        if self.pruning is None or len(results) == 0:
+            return results
+        return results.iloc[flight_positions(results['Price'].to_numpy(), results['ArrTime'].to_numpy())]
+
+
+
+    def encoded_candidates(self, origin, destination, departure_date):
+        """Return the flights encoded for one route and date, looking them up only for a leg the solver code did not encode."""
+        rows = self.encoded.get((origin, destination, departure_date))
+        if rows is None:
+            return self.candidates(origin, destination, departure_date)
+        return rows
+
+    def leg(self, origin, destination, departure_date):
+        """Return the price, departure hour and arrival hour lists of the flights encoded on one route and date."""
+        if self.table is not None and self.pruning is None:
+            # the shared table finds a leg's rows by their span, so decoding looks them up again instead of keeping a copy
+            return self.table.leg(origin, destination, departure_date)
+        candidates = self.candidates(origin, destination, departure_date)
+        self.encoded[(origin, destination, departure_date)] = candidates
+        rows = np.array(candidates)
+        if len(rows) == 0:
+            return [], [], []
+        return list(rows[:,1]), _convert_time(rows[:,2]), _convert_time(rows[:,3])
+
     def run_search(self, origin, departure_date):
         """ Return list of unique destinations from origin on a specific date """
-        results = self.data[self.data["OriginCityName"] == origin]
-        results = results[results["FlightDate"] == departure_date]
+        if self.table is not None:
+            destinations = self.table.destinations(origin, departure_date)
+            if len(destinations) > 0:
+                return destinations
+            return "There is no flight from {} on {}.".format(origin, departure_date)
+        results = self.data[(self.data['OriginCityName'] == origin) & (self.data['FlightDate'] == departure_date)]
         if len(results) > 0:
             return np.unique(np.array(results['DestCityName']))
         else:
@@ -57,9 +141,7 @@ class Flights:
 
     def run(self, origin: str, destination: str, departure_date: str ) -> DataFrame:
         """Search for flights by origin, destination, and departure date."""
-        results = self.data[self.data["OriginCityName"] == origin]
-        results = results[results["DestCityName"] == destination]
-        results = results[results["FlightDate"] == departure_date]
+        results = self.lookup(origin, destination, departure_date)
         # if order == "ascPrice":
         #     results = results.sort_values(by=["Price"], ascending=True)
         # elif order == "descPrice":
@@ -86,60 +168,53 @@ class Flights:
             ) -> DataFrame:
         """Build Z3 arrays of flights for multiple cities and dates"""
 
-        def convert_time(times):
-            output = []
-            for time in times:
-                hour = time.split(':')[0]
-                minute = time.split(':')[1]
-                time_float = int(hour) + float(minute)/60
-                output.append(time_float)
-            return output
 
         # cities.append(origin)
         cities = copy.deepcopy(cities_list)
         cities.insert(0, origin)
+        self.all_cities = list(all_cities)
         all_cities = copy.deepcopy(all_cities)
         all_cities.insert(0, origin)
+        city_index = first_positions(all_cities)
 
         results = Array('flights', IntSort(), IntSort(), IntSort(), IntSort(), ArraySort(IntSort(), RealSort())) # ori, dest, date, [Price, DepTime, ArrTime], info
+        if self.encoding == 'flat':
+            results = FlatTable('flights', {'Price': RealSort(), 'DepTime': RealSort(), 'ArrTime': RealSort(), 'Length': RealSort()})
         
-        for i, ori in enumerate(cities):
-            if i!= len(cities)-1:
-                destination = cities[i+1]
-            else:
-                destination = cities[0]
+        for ori, destination in city_legs(cities):
             
             for d, departure_date in enumerate(departure_dates):
                 # print(origin, destination)
-                result = self.data[self.data["OriginCityName"] == ori]
-                # print(result)
-                result = result[result["DestCityName"] == destination]
-                result = result[result["FlightDate"] == departure_date]
-
-                if len(result) != 0:
+                Price, DepTime, ArrTime = self.leg(ori, destination, departure_date)
+                if self.encoding == 'flat':
+                    if len(Price) != 0:
+                        results.add((city_index[ori], city_index[destination], d), Price=Price, DepTime=DepTime, ArrTime=ArrTime, Length=[len(Price)])
+                    else:
+                        results.add((city_index[ori], city_index[destination], d), Length=[-1])
+                    continue
+
+                if len(Price) != 0:
                     price = Array('Price', IntSort(), RealSort())
                     depTime = Array('DepTime', IntSort(), RealSort())
                     arrTime = Array('ArrTime', IntSort(), RealSort())
                     length = Array('Length', IntSort(), RealSort())
 
-                    DepTime = convert_time(np.array(result)[:,2])
-                    ArrTime = convert_time(np.array(result)[:,3])
-                    length = Store(length, 0, len(np.array(result)[:,1]))
+                    length = Store(length, 0, len(Price))
 
-                    for index in range(np.array(result).shape[0]):
-                        price = Store(price, index, np.array(result)[:,1][index])
+                    for index in range(len(Price)):
+                        price = Store(price, index, Price[index])
                         depTime = Store(depTime, index, DepTime[index])
                         arrTime = Store(arrTime, index, ArrTime[index])
 
-                    results = Store(results, all_cities.index(ori), all_cities.index(destination), d, 0, price)
-                    results = Store(results, all_cities.index(ori), all_cities.index(destination), d, 1, depTime)
-                    results = Store(results, all_cities.index(ori), all_cities.index(destination), d, 2, arrTime)
-                    results = Store(results, all_cities.index(ori), all_cities.index(destination), d, 3, length)
+                    results = Store(results, city_index[ori], city_index[destination], d, 0, price)
+                    results = Store(results, city_index[ori], city_index[destination], d, 1, depTime)
+                    results = Store(results, city_index[ori], city_index[destination], d, 2, arrTime)
+                    results = Store(results, city_index[ori], city_index[destination], d, 3, length)
                 else:
                     # import pdb; pdb.set_trace()
                     length = Array('Length', IntSort(), RealSort())
                     length = Store(length, 0, -1)
-                    results = Store(results, all_cities.index(ori), all_cities.index(destination), d, 3, length)
+                    results = Store(results, city_index[ori], city_index[destination], d, 3, length)
         return results
 
 
@@ -159,6 +234,8 @@ class Flights:
         else:
             i += 1
             j += 1
+        if isinstance(info, FlatTable):
+            return info.column((i, j, d), key), info.length((i, j, d))
         info_key = Select(info, i, j, d, element.index(key))
         info_length = Select(info, i, j, d, 3)
         length = Select(info_length, 0)
@@ -168,6 +245,8 @@ class Flights:
 
     def get_info_for_index(self, info_list, index):
         """ Return the value from a Z3 Array { ArraySort(IntSort(), RealSort()) } at the given index.  """
+        if isinstance(info_list, FlatColumn):
+            return info_list.select(index)
         return Select(info_list, index)
 
 
@@ -178,9 +257,7 @@ class Flights:
             departure_date: str,
             ) -> DataFrame:
         """Search for flights by origin, destination, and departure date."""
-        results = self.data[self.data["OriginCityName"] == extract_before_parenthesis(origin)]
-        results = results[results["DestCityName"] == extract_before_parenthesis(destination)]
-        results = results[results["FlightDate"] == departure_date]
+        results = self.lookup(extract_before_parenthesis(origin), extract_before_parenthesis(destination), departure_date)
         # if order == "ascPrice":
         #     results = results.sort_values(by=["Price"], ascending=True)
         # elif order == "descPrice":
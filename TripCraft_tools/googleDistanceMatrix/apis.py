@@ -1,5 +1,8 @@
 import requests
 from utils.func import extract_before_parenthesis
+from utils.database import load_database
+from utils.legs import city_legs
+from utils.interning import first_positions, city_ids, intern_columns
 import re
 import json
 import os
@@ -17,18 +20,59 @@ def extract_before_parenthesis(s):
     match = re.search(r'^(.*?)\([^)]*\)', s)
     return match.group(1) if match else s
 
+def _index_distances(data):
+    # dense (origin, destination) arrays over every city of the table, all read from the first row of a pair:
+    # its position (-1 when there is none), whether neither value is missing as run_check tests it (by
+    # identity) and as run tests it (by NaN), and the duration in minutes and the distance in km as numbers
+    cities = sorted(set(data['origin']) | set(data['destination']))
+    codes = {city: code for code, city in enumerate(cities)}
+    shape = (len(cities), len(cities))
+    index = {'codes': codes, 'row': np.full(shape, -1, dtype=np.int64), 'given': np.zeros(shape, dtype=bool),
+             'valid': np.zeros(shape, dtype=bool), 'minutes': np.full(shape, np.nan), 'km': np.full(shape, np.nan)}
+    positions = np.flatnonzero(~data.duplicated(['origin', 'destination']).to_numpy())
+    pairs = tuple(np.array([codes[city] for city in data[column].to_numpy()[positions]], dtype=np.int64) for column in ['origin', 'destination'])
+    duration = data['duration_min'].values[positions]
+    distance = data['distance_km'].values[positions]
+    minutes = pd.to_numeric(pd.Series(duration, dtype=object), errors='coerce').to_numpy(dtype=float)
+    km = pd.to_numeric(pd.Series(distance, dtype=object), errors='coerce').to_numpy(dtype=float)
+    index['row'][pairs] = positions
+    index['given'][pairs] = [not (d is None or k is None or d is np.nan or k is np.nan) for d, k in zip(duration, distance)]
+    index['valid'][pairs] = ~(np.isnan(minutes) | np.isnan(km))
+    index['minutes'][pairs] = minutes
+    index['km'][pairs] = km
+    return index
+
+def _intern_distances(data):
+    return intern_columns(data, {'origin': city_ids, 'destination': city_ids})
+
 class GoogleDistanceMatrix:
-    def __init__(self, subscription_key: str="") -> None:
+    def __init__(self, subscription_key: str="", path="TripCraft_database/distance_matrix/city_distances_times_full.csv") -> None:
         self.gplaces_api_key: str = subscription_key
-        self.data =  pd.read_csv('TripCraft_database/distance_matrix/city_distances_times_full.csv')
+        self.path = path
+        # the city list the solver code was given
+        self.all_cities = None
+        self.data =  load_database('TripCraft', 'distance', self.path, pd.read_csv, cache=True, prepare=_intern_distances)
+        self.index = load_database('TripCraft', 'distance_index', self.path, lambda path: _index_distances(self.data), cache=True)
         print("OSM_DistanceMatrix loaded.")
 
 
 
+    def lookup(self, origin, destination):
+        """Return the position of the (origin, destination) pair in the arrays of self.index, or None when the table has no row for it."""
+        codes = self.index['codes']
+        if origin not in codes or destination not in codes:
+            return None
+        pair = (codes[origin], codes[destination])
+        if self.index['row'][pair] == -1:
+            return None
+        return pair
+
+
+
     def run_check(self, origin, destination):
-        response = self.data[(self.data['origin'] == origin) & (self.data['destination'] == destination)]
-        if len(response) > 0:
-            if response['duration_min'].values[0] is None or response['distance_km'].values[0] is None or response['duration_min'].values[0] is np.nan or response['distance_km'].values[0] is np.nan:
+        pair = self.lookup(origin, destination)
+        if pair is not None:
+            if not self.index['given'][pair]:
                     return f'Driving is not feasible from {origin} to {destination}'
             else:
                 return f'Driving exists from {origin} to {destination}'
@@ -38,7 +82,7 @@ class GoogleDistanceMatrix:
 
 
     def run_search(self, origin):
-        response = self.data[(self.data['origin'] == origin)]
+        response = self.data[self.data['origin'] == origin]
         if len(response) > 0:
             return np.unique(np.array(response['destination']))
         else:
@@ -50,12 +94,12 @@ class GoogleDistanceMatrix:
         origin = extract_before_parenthesis(origin)
         destination = extract_before_parenthesis(destination)
         info = {"origin": origin, "destination": destination,"cost": None, "duration": None, "distance": None}
-        response = self.data[(self.data['origin'] == origin) & (self.data['destination'] == destination)]
-        if len(response) > 0:
-                if response['duration_min'].values[0] is None or response['distance_km'].values[0] is None or np.isnan(response['duration_min'].values[0]) or np.isnan(response['distance_km'].values[0]):
+        pair = self.lookup(origin, destination)
+        if pair is not None:
+                if not self.index['valid'][pair]:
                     return "No valid information."
-                info["duration"] = response['duration_min'].values[0]
-                info["distance"] = response['distance_km'].values[0]
+                info["duration"] = self.data['duration_min'].values[self.index['row'][pair]]
+                info["distance"] = self.data['distance_km'].values[self.index['row'][pair]]
                 # print(info["duration"],type(info["duration"]))
                 # print(info["distance"],type(info["distance"]))
                 if 'driving' in mode:
@@ -78,12 +122,12 @@ class GoogleDistanceMatrix:
         origin = extract_before_parenthesis(origin)
         destination = extract_before_parenthesis(destination)
         info = {"origin": origin, "destination": destination,"cost": None, "duration": None, "distance": None}
-        response = self.data[(self.data['origin'] == origin) & (self.data['destination'] == destination)]
-        if len(response) > 0:
-                if response['duration_min'].values[0] is None or response['distance_km'].values[0] is None or response['duration_min'].values[0] is np.nan or response['distance_km'].values[0] is np.nan:
+        pair = self.lookup(origin, destination)
+        if pair is not None:
+                if not self.index['given'][pair]:
                     return info
-                info["duration"] = response['duration_min'].values[0]
-                info["distance"] = response['distance_km'].values[0]
+                info["duration"] = self.data['duration_min'].values[self.index['row'][pair]]
+                info["distance"] = self.data['distance_km'].values[self.index['row'][pair]]
 
                 
                 if int(info["duration"])< 1440:
@@ -173,29 +217,26 @@ class GoogleDistanceMatrix:
         """Search for flights by origin, destination, and departure date."""
         cities = copy.deepcopy(cities_list)
         cities.insert(0, origin)
+        self.all_cities = list(all_cities)
         all_cities = copy.deepcopy(all_cities)
         all_cities.insert(0, origin)
+        city_index = first_positions(all_cities)
 
         results = Array('driving', IntSort(), IntSort(), IntSort(), RealSort()) # origin_city destination_city [distance duration cost length] information
 
-        for i, ori in enumerate(cities):
-            if i!= len(cities)-1:
-                destination = cities[i+1]
-            else:
-                destination = cities[0]
-
-            result = self.data[self.data["origin"] == ori]
-            result = result[result["destination"] == destination]
-
-            if len(result) != 0 and (type(np.array(result)[0][3])==str or not math.isnan(np.array(result)[0][3])) and int(np.array(result)[0][3])< 1440:
-                duration = int(np.array(result)[0][3]) 
-                distance = int(np.array(result)[0][2])
-                results = Store(results, all_cities.index(ori), all_cities.index(destination), 0, distance)
-                results = Store(results, all_cities.index(ori), all_cities.index(destination), 1, duration)
-                results = Store(results, all_cities.index(ori), all_cities.index(destination), 2, distance * 0.05)
-                results = Store(results, all_cities.index(ori), all_cities.index(destination), 3, 1)
+        for ori, destination in city_legs(cities):
+
+            pair = self.lookup(ori, destination)
+
+            if pair is not None and self.index['valid'][pair] and int(self.index['minutes'][pair]) < 1440:
+                duration = int(self.index['minutes'][pair]) 
+                distance = int(self.index['km'][pair])
+                results = Store(results, city_index[ori], city_index[destination], 0, distance)
+                results = Store(results, city_index[ori], city_index[destination], 1, duration)
+                results = Store(results, city_index[ori], city_index[destination], 2, distance * 0.05)
+                results = Store(results, city_index[ori], city_index[destination], 3, 1)
             else:
-                results = Store(results, all_cities.index(ori), all_cities.index(destination), 3, -1)
+                results = Store(results, city_index[ori], city_index[destination], 3, -1)
         return results
 
 
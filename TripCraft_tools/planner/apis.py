@@ -20,9 +20,10 @@ import time
 from enum import Enum
 from typing import List, Union, Literal
 # from langchain_google_genai import ChatGoogleGenerativeAI
-from transformers import AutoModelForCausalLM, AutoTokenizer
+from transformers import AutoModelForCausalLM, AutoTokenizer, StoppingCriteriaList
 import torch
 import argparse
+from utils.local_llm import StopOnStrings, check_memory, check_quantize, cut_at_stop, load_cpu_model
 
 
 OPENAI_API_KEY = os.environ['OPENAI_API_KEY']
@@ -56,10 +57,19 @@ class Planner:
     def __init__(self,
                  agent_prompt: PromptTemplate = planner_agent_prompt_direct_og,
                  model_name: str = 'gpt-3.5-turbo-1106',
+                 stop: List[str] = None,
+                 fence: bool = False,
+                 device: str = None,
+                 quantize: str = None,
+                 threads: int = None,
+                 max_memory_gb: float = None,
                  ) -> None:
         self.agent_prompt = agent_prompt
         self.scratchpad: str = ''
         self.model_name = model_name
+        # local models stop at the first of these strings, or with fence at the end of the first code block
+        self.stop = stop
+        self.fence = fence
         self.enc = tiktoken.encoding_for_model("gpt-3.5-turbo")
         
         if model_name in ['qwen','phi4']:
@@ -68,14 +78,25 @@ class Planner:
                 'phi4': "microsoft/Phi-4-mini-instruct"
             }[model_name]
             
+            device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+            check_quantize(quantize, device)
+            if device == "cpu":
+                check_memory(model_path, quantize, max_memory_gb)
+            if threads:
+                torch.set_num_threads(threads)
+
             self.tokenizer = AutoTokenizer.from_pretrained(model_path)
-            self.model = AutoModelForCausalLM.from_pretrained(
-                model_path,
-                torch_dtype=torch.float16,
-                device_map="auto",
-                offload_folder="offload",  # Enables CPU offloading
-                attn_implementation="flash_attention_2"  # Speeds up inference
-            )
+            if device == "cpu":
+                # float16 and flash-attention need a GPU
+                self.model = load_cpu_model(model_path, quantize)
+            else:
+                self.model = AutoModelForCausalLM.from_pretrained(
+                    model_path,
+                    torch_dtype=torch.float16,
+                    device_map="auto",
+                    offload_folder="offload",  # Enables CPU offloading
+                    attn_implementation="flash_attention_2"  # Speeds up inference
+                )
         else:
             self.llm = ChatOpenAI(model_name=model_name, temperature=0, max_tokens=4096, openai_api_key=OPENAI_API_KEY)
         
@@ -88,16 +109,19 @@ class Planner:
         prompt = self._build_agent_prompt(text, query, persona)
         
         if self.model_name in ['qwen','phi4']:
-            inputs = self.tokenizer(prompt, return_tensors="pt").to("cuda")
+            inputs = self.tokenizer(prompt, return_tensors="pt").to(self.model.device)
+            stopping_criteria = None
+            if self.stop or self.fence:
+                stopping_criteria = StoppingCriteriaList([StopOnStrings(self.tokenizer, inputs["input_ids"].shape[-1], self.stop, self.fence)])
             # print(self.model.generation_config)
-            output = self.model.generate(**inputs, max_new_tokens=3072) #do_sample=False) # temperature=0.0) #equivalent
+            output = self.model.generate(**inputs, max_new_tokens=3072, stopping_criteria=stopping_criteria) #do_sample=False) # temperature=0.0) #equivalent
             generated_text = self.tokenizer.decode(output[0], skip_special_tokens=True)
             
             response_start = generated_text.find(prompt)
             if response_start != -1:
                 generated_text = generated_text[response_start + len(prompt):].strip()
             
-            return generated_text
+            return cut_at_stop(generated_text, self.stop, self.fence).strip()
         else:
             if len(self.enc.encode(prompt)) > 12000:
                 return 'Max Token Length Exceeded.'
@@ -9,7 +9,7 @@ import math
 class ReactEnv:
     def __init__(self):
         
-        self.flight = Flights()
+        self.flight = Flights(mmap=False)
         self.accommodation = Accommodations()
         self.restaurants = Restaurants()
         self.googleDistanceMatrix = GoogleDistanceMatrix()
@@ -49,6 +49,12 @@ if __name__ == "__main__":
     parser.add_argument("--output_dir", type=str, default="./")
     parser.add_argument("--strategy", type=str, default="direct_og")
     parser.add_argument("--csv_file", type=str, required=True, help="Path to the reference_info.csv file")
+    parser.add_argument("--stop", type=str, nargs="*", default=None, help="Strings at which local models stop generating")
+    parser.add_argument("--fence", action="store_true", help="Stop local models once they close their first code block")
+    parser.add_argument("--device", type=str, default=None, choices=["cuda", "cpu"], help="Device of local models, cuda when available by default")
+    parser.add_argument("--quantize", type=str, default=None, choices=["int8", "int4"], help="Weight quantization of local models on CPU")
+    parser.add_argument("--threads", type=int, default=None, help="Torch threads of local models on CPU")
+    parser.add_argument("--max_memory_gb", type=float, default=None, help="Refuse to load a local model whose estimated peak memory is above this")
     args = parser.parse_args()
 
     # Load data from CSV
@@ -61,10 +67,12 @@ if __name__ == "__main__":
 
     # Define planner based on strategy
     if args.strategy == 'direct_og':
-        planner = Planner(model_name=args.model_name, agent_prompt=planner_agent_prompt_direct_og)
+        planner = Planner(model_name=args.model_name, agent_prompt=planner_agent_prompt_direct_og, stop=args.stop, fence=args.fence,
+                          device=args.device, quantize=args.quantize, threads=args.threads, max_memory_gb=args.max_memory_gb)
     else:
         if args.strategy == 'direct_param':
-            planner = Planner(model_name=args.model_name, agent_prompt=cot_planner_agent_prompt_param)
+            planner = Planner(model_name=args.model_name, agent_prompt=cot_planner_agent_prompt_param, stop=args.stop, fence=args.fence,
+                              device=args.device, quantize=args.quantize, threads=args.threads, max_memory_gb=args.max_memory_gb)
 
     # Iterate over data and generate results
     with get_openai_callback() as cb:
@@ -3,12 +3,53 @@ import numpy as np
 from pandas import DataFrame
 from typing import Optional
 from utils.func import extract_before_parenthesis
+from utils.database import load_database
+from utils.flat_table import FlatTable, FlatColumn
+from utils.pruning import restaurant_positions
+from utils.interning import first_positions, city_ids, intern_columns
 from z3 import *
 
+def _load_restaurants(path):
+    df = pd.read_csv(path)
+    df = df.rename(columns={
+        "name" : "Name", 
+        "avg_cost" : "Average Cost",
+        "cuisines" : "Cuisines",
+        "rating" : "Aggregate Rating",
+        "City" : "City" 
+    })
+    return df[['Name','Average Cost','Cuisines','Aggregate Rating','City']].dropna()
+
+_CUISINES = ['Chinese', 'American', 'Italian', 'Mexican', 'Indian', 'Mediterranean', 'French']
+
+def _index_restaurants(data):
+    # per city: the first row of every restaurant name in table order, with its price and a bitmask
+    # of the listed cuisines (bit j set when _CUISINES[j] appears in the Cuisines text)
+    unique = data[~data.duplicated(['City', 'Name'])]
+    masks = np.zeros(len(unique), dtype=np.int64)
+    for j, cuisine in enumerate(_CUISINES):
+        masks |= unique['Cuisines'].str.contains(cuisine, regex=False).to_numpy(dtype=np.int64) << j
+    prices = unique['Average Cost'].to_numpy()
+    index = {}
+    for city, rows in unique.groupby('City', sort=False, observed=True).indices.items():
+        index[city] = {'rows': unique.iloc[rows], 'price': prices[rows].tolist(), 'cuisines': masks[rows].tolist()}
+    return index
+
+def _intern_restaurants(data):
+    return intern_columns(data, {'City': city_ids})
+
 class Restaurants:
-    def __init__(self, path="TripCraft_database/restaurants/cleaned_restaurant_details_2024.csv"):
+    def __init__(self, path="TripCraft_database/restaurants/cleaned_restaurant_details_2024.csv", encoding="array"):
         self.path = path
-        self.data = self.load_db()
+        self.pruning = None
+        # the candidate rows of every city the solver code encoded, and the city list it was given, so that
+        # the model is decoded against the rows its indices refer to
+        self.encoded = {}
+        self.all_cities = None
+        # "array" builds nested Z3 Store terms, "flat" builds FlatTable If-chains over the candidate rows
+        self.encoding = encoding
+        self.data = load_database('TripCraft', 'restaurants', self.path, _load_restaurants, cache=True, prepare=_intern_restaurants)
+        self.index = load_database('TripCraft', 'restaurants_index', self.path, lambda path: _index_restaurants(self.data), cache=True)
         print(self.data.columns)
         print("Restaurants loaded.")
 
@@ -16,16 +57,8 @@ class Restaurants:
 
     def load_db(self):
         """ load database and feature analysis"""
-        df = pd.read_csv(self.path)
-        df = df.rename(columns={
-            "name" : "Name", 
-            "avg_cost" : "Average Cost",
-            "cuisines" : "Cuisines",
-            "rating" : "Aggregate Rating",
-            "City" : "City" 
-        })
-        self.data = df[['Name','Average Cost','Cuisines','Aggregate Rating','City']]
-        self.data = self.data.dropna()
+        self.data = _intern_restaurants(_load_restaurants(self.path))
+        self.index = _index_restaurants(self.data)
         return self.data
 
 
@@ -34,28 +67,44 @@ class Restaurants:
             city: str,
             ) -> DataFrame:
         """Search for restaurant ."""
-        results = self.data[self.data["City"] == city]
-        # results = results[results["date"] == date]
-        # if price_order == "asc":
-        #     results = results.sort_values(by=["Average Cost"], ascending=True)
-        # elif price_order == "desc": 
-        #     results = results.sort_values(by=["Average Cost"], ascending=False)
+        if city not in self.index:
+            return "There is no restaurant in this city."
+        # restaurants repeated under the same name are listed once, as in the solver encoding
+        return self.index[city]['rows']
 
-        # if rating_order == "asc":
-        #     results = results.sort_values(by=["Aggregate Rating"], ascending=True)
-        # elif rating_order == "desc":
-        #     results = results.sort_values(by=["Aggregate Rating"], ascending=False)
-        if len(results) == 0:
+
+
+    def set_pruning(self, query):
+        """Encode only the non-dominated restaurants for `query` (the query JSON), or every restaurant when it is None."""
+        self.pruning = query
+        self.encoded = {}
+
+
+
+    def candidate_index(self, city):
+        """Return the index entry of `city` restricted to the restaurants the solver encodes."""
+        restaurants = self.index[city]
+        if self.pruning is None:
+            return restaurants
+        kept = restaurant_positions(restaurants['price'], restaurants['cuisines'], self.pruning)
+        return {'rows': restaurants['rows'].iloc[kept], 'price': [restaurants['price'][k] for k in kept], 'cuisines': [restaurants['cuisines'][k] for k in kept]}
+
+
+
+    def candidates(self, city):
+        """Return the restaurants the solver encodes for `city`; model indices refer to these rows."""
+        if city not in self.index:
             return "There is no restaurant in this city."
-        non_repeat = []
-        drop_index = []
-        for index in range(np.array(results).shape[0]):
-            name = np.array(results)[:,0][index]
-            if name not in non_repeat:
-                non_repeat.append(name)
-            else:
-                drop_index.append(results.index.to_numpy()[index])
-        return results.drop(drop_index)#.to_string()
+        return self.candidate_index(city)['rows']
+
+
+
+    def encoded_candidates(self, city):
+        """Return the restaurants encoded for `city`, looking them up only for a city the solver code did not encode."""
+        rows = self.encoded.get(city)
+        if rows is None:
+            return self.candidates(city)
+        return rows
 
 
 
@@ -63,48 +112,61 @@ class Restaurants:
             cities: list,
             ) -> DataFrame:
         """Search for flights by origin, destination, and departure date."""
-        cuisines_list = ['Chinese', 'American', 'Italian', 'Mexican', 'Indian', 'Mediterranean', 'French']
-
+        self.all_cities = list(all_cities)
+        if self.encoding == 'flat':
+            return self.run_for_all_cities_flat(all_cities, cities)
+        city_index = first_positions(all_cities)
         results = Array('restaurant', IntSort(), IntSort(), ArraySort(IntSort(), IntSort())) # ori, dest, date, [Price, DepTime, ArrTime], info
-        results_cuisines = Array('restaurant cuisines', IntSort(), ArraySort(IntSort(), IntSort(), BoolSort())) # ori, dest, date, [Price, DepTime, ArrTime], info
+        results_cuisines = Array('restaurant cuisines', IntSort(), ArraySort(IntSort(), BitVecSort(8))) # ori, dest, date, [Price, DepTime, ArrTime], info
         
         for i, city in enumerate(cities):
-            result = self.data[self.data["City"] == city]
-            if len(result) != 0:
+            if city in self.index:
                 # import pdb; pdb.set_trace()
 
                 price = Array('Price', IntSort(), IntSort())
-                cuisines = Array('Cuisines', IntSort(), IntSort(), BoolSort())
+                cuisines = Array('Cuisines', IntSort(), BitVecSort(8))
                 length = Array('Length', IntSort(), IntSort())
 
-                non_repeat = []
-                non_repeat_index = []
-                for index in range(np.array(result).shape[0]):
-                    name = np.array(result)[:,0][index]
-                    if name not in non_repeat:
-                        non_repeat.append(name)
-                        non_repeat_index.append(index)
-                for order, index in enumerate(non_repeat_index):
-                    price = Store(price, order, np.array(result)[:,1][index])
-                    types = np.array(result)[:,2][index]
-                    for j in range(len(cuisines_list)):
-                        cuisines = Store(cuisines, order, j, cuisines_list[j] in types)
-
-                length = Store(length, 0, len(non_repeat_index))
-                results = Store(results, all_cities.index(city), 0, price)
-                results = Store(results, all_cities.index(city), 1, length)
+                restaurants = self.candidate_index(city)
+                self.encoded[city] = restaurants['rows']
+                for order, (cost, mask) in enumerate(zip(restaurants['price'], restaurants['cuisines'])):
+                    price = Store(price, order, cost)
+                    cuisines = Store(cuisines, order, BitVecVal(mask, 8))
+
+                length = Store(length, 0, len(restaurants['price']))
+                results = Store(results, city_index[city], 0, price)
+                results = Store(results, city_index[city], 1, length)
                 # print('length!!!', length)
-                results_cuisines = Store(results_cuisines, all_cities.index(city), cuisines)
+                results_cuisines = Store(results_cuisines, city_index[city], cuisines)
             else:
                 length = Array('Length', IntSort(), IntSort())
                 length = Store(length, 0, -1)
-                results = Store(results, all_cities.index(city), 1, length)
+                results = Store(results, city_index[city], 1, length)
         return results, results_cuisines
 
 
 
+    def run_for_all_cities_flat(self, all_cities: list, cities: list):
+        """Flat counterpart of run_for_all_cities: one FlatTable holding both the price and the cuisine columns."""
+        city_index = first_positions(all_cities)
+        table = FlatTable('restaurant', {'Price': IntSort(), 'Length': IntSort(), 'Cuisines': BitVecSort(8)})
+        for city in cities:
+            if city in self.index:
+                restaurants = self.candidate_index(city)
+                self.encoded[city] = restaurants['rows']
+                table.add((city_index[city],), Price=restaurants['price'], Length=[len(restaurants['price'])], Cuisines=restaurants['cuisines'])
+            else:
+                table.add((city_index[city],), Length=[-1])
+        return table, table
+
+
+
     def get_info(self, info, i, key):
         # ['Price', 'Length']
+        if isinstance(info, FlatTable):
+            if key == 'Cuisines':
+                return info.column((i,), key), None
+            return info.column((i,), key), info.length((i,))
         if key == 'Cuisines':
             info_key = Select(info, i)
             return info_key, None
@@ -117,6 +179,8 @@ class Restaurants:
 
 
     def get_info_for_index(self, price_list, index):
+        if isinstance(price_list, FlatColumn):
+            return price_list.select(index)
         return Select(price_list, index)
 
 
@@ -149,8 +213,12 @@ class Restaurants:
 
 
     def check_exists(self, cuisine, restaurant_cuisines_list, restaurant_index):
-        cuisines_list = ['Chinese', 'American', 'Italian', 'Mexican', 'Indian', 'Mediterranean', 'French']
-        exists = Select(restaurant_cuisines_list, restaurant_index, cuisines_list.index(cuisine))
+        # cuisines are bitmasks, with the bit of each cuisine at its position in _CUISINES
+        bit = _CUISINES.index(cuisine)
+        if isinstance(restaurant_cuisines_list, FlatColumn):
+            exists = restaurant_cuisines_list.any(lambda mask: mask >> bit & 1, restaurant_index)
+        else:
+            exists = Extract(bit, bit, Select(restaurant_cuisines_list, restaurant_index)) == 1
         return If(restaurant_index != -1, exists, False)
 
 
@@ -159,7 +227,7 @@ class Restaurants:
             city: str,
             ) -> DataFrame:
         """Search for restaurant ."""
-        results = self.data[self.data["City"] == extract_before_parenthesis(city)]
+        results = self.data[self.data['City'] == extract_before_parenthesis(city)]
         # results = results[results["date"] == date]
         # if price_order == "asc":
         #     results = results.sort_values(by=["Average Cost"], ascending=True)
@@ -1,46 +1,80 @@
 import os
+import copy
 import torch
-from transformers import AutoTokenizer, AutoModelForCausalLM
+from collections import OrderedDict
+from transformers import AutoTokenizer, AutoModelForCausalLM, DynamicCache, StoppingCriteriaList
+
+from utils.llm_cache import cached_response, llm_cache
+from utils.local_llm import StopOnStrings, check_memory, check_quantize, cut_at_stop, load_cpu_model
 
 
 class LLMWrapper:
     _model_cache = {}
+    # past key values of static prompt prefixes (the few-shot parts of the prompts), by model and prefix.
+    # A query uses 11 of them (JSON, steps and 9 step-to-code prompts), so the default keeps them all and a
+    # few spare; for Qwen2.5-7B in float32 they take about 0.11 MB per token, some 1.5 GB for those 11
+    _prefix_cache = OrderedDict()
+    MAX_PREFIXES = int(os.environ.get('LLM_MAX_PREFIXES', 16))
     SUPPORTED_MODELS = {
         "llama": "meta-llama/Llama-2-7b-chat-hf",
         "qwen": "Qwen/Qwen2.5-7B-Instruct",
         "phi": "microsoft/Phi-4"
     }
 
-    def __init__(self, model_key: str = "llama", device: str = None):
-        try:
-            if model_key in self.SUPPORTED_MODELS:
-                self.model_name = self.SUPPORTED_MODELS[model_key]
-            else:
-                self.model_name = model_key      #HF model ID directly
+    def __init__(self, model_key: str = "llama", device: str = None, quantize: str = None, threads: int = None,
+                 max_memory_gb: float = None):
+        """
+        On CPU, `quantize` stores the weights of the linear layers in "int8" (torch dynamic quantization) or
+        "int4" (optimum-quanto), `threads` sets the threads torch computes with, and the model is only
+        loaded if its estimated peak memory fits in `max_memory_gb` and in the memory available; a bad
+        `quantize` raises ValueError and a model that does not fit MemoryError.
+        """
+        if model_key in self.SUPPORTED_MODELS:
+            self.model_name = self.SUPPORTED_MODELS[model_key]
+        else:
+            self.model_name = model_key      #HF model ID directly
 
-            self.device = device or ("cuda" if torch.cuda.is_available() else "cpu")
-            print(self.device)
+        self.device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+        print(self.device)
+        # checked before the load below, whose errors are only printed
+        check_quantize(quantize, self.device)
+        self.quantize = quantize
+        # a quantized model answers differently, so it has its own model, prefix and response cache entries
+        self.cache_name = self.model_name if quantize is None else f"{self.model_name}:{quantize}"
+        if threads:
+            torch.set_num_threads(threads)
+        if self.device == "cpu" and self.cache_name not in self._model_cache:
+            check_memory(self.model_name, quantize, max_memory_gb)
 
-            if self.model_name in self._model_cache:
-                self.tokenizer, self.model = self._model_cache[self.model_name]
-                print(f"Loaded {self.model_name} from cache.")
+        try:
+            if self.cache_name in self._model_cache:
+                self.tokenizer, self.model = self._model_cache[self.cache_name]
+                print(f"Loaded {self.cache_name} from cache.")
                 return
 
-            print(f"Loading model: {self.model_name} on {self.device}")
+            print(f"Loading model: {self.cache_name} on {self.device}")
 
             tokenizer = AutoTokenizer.from_pretrained(self.model_name)
-            model = AutoModelForCausalLM.from_pretrained(
-                self.model_name,
-                torch_dtype=torch.float16 if self.device == "cuda" else torch.float32,
-                device_map="auto" if self.device == "cuda" else None,
-                trust_remote_code=True,
-                # offload_folder="offload",  # Enables CPU offloading
-                # attn_implementation="flash_attention_2"  # Speeds up inference
-            )
+            if self.device == "cpu":
+                model = load_cpu_model(self.model_name, quantize, trust_remote_code=True)
+            else:
+                model = AutoModelForCausalLM.from_pretrained(
+                    self.model_name,
+                    torch_dtype=torch.float16,
+                    device_map="auto",
+                    trust_remote_code=True,
+                    # offload_folder="offload",  # Enables CPU offloading
+                    # attn_implementation="flash_attention_2"  # Speeds up inference
+                )
+
+            # batches are padded on the left, so that every prompt ends right where its generation starts
+            tokenizer.padding_side = "left"
+            if tokenizer.pad_token is None:
+                tokenizer.pad_token = tokenizer.eos_token
 
             self.tokenizer = tokenizer
             self.model = model
-            self._model_cache[self.model_name] = (tokenizer, model)
+            self._model_cache[self.cache_name] = (tokenizer, model)
 
         except Exception as e:
             print(f"Error loading model {self.model_name}: {e}")
@@ -50,31 +84,170 @@ class LLMWrapper:
         prompt: str,
         max_new_tokens: int = 3072,
         temperature: float = 0,
+        prefix: str = None,
+        stop: list = None,
+        fence: bool = False,
     ) -> str:
+        """
+        `prefix` is the static start of `prompt`, shared by many prompts: its past key values are computed
+        once and generation resumes from them, so only the rest of the prompt is prefilled.
+        Generation ends at the first of the `stop` strings, or with `fence` once the answer has closed the
+        code fence it opened; the answer is cut right after it.
+        """
+        # decoding is greedy (do_sample=False), so the answer only depends on the model and its inputs
+        return cached_response(self._settings(temperature, max_new_tokens, stop, fence), prompt,
+                               lambda: self._generate(prompt, max_new_tokens, temperature, prefix, stop, fence))
+
+    def _settings(self, temperature, max_new_tokens, stop, fence):
+        settings = ['huggingface', self.cache_name, "", temperature, max_new_tokens]
+        # answers cut at a stop are cached apart; without stops the keys stay those of earlier runs
+        return settings + [stop or [], fence] if stop or fence else settings
+
+    def _chat_inputs(self, prompt):
+        messages = [{"role": "user", "content": prompt}]
+        return self.tokenizer.apply_chat_template(
+            messages,
+            add_generation_prompt=True,
+            tokenize=True,
+            return_dict=True,
+            return_tensors="pt",
+        ).to(self.model.device)
+
+    def _prefix_past(self, prefix, input_ids):
+        """
+        Return a copy of the cached past key values of `prefix` that covers the start of `input_ids`,
+        computing them on first use, or None when `prefix` is not where the chat input starts.
+        """
+        key = (self.cache_name, prefix)
+        ids = input_ids[0]
+        if key not in self._prefix_cache:
+            # the prefix is tokenized inside the chat template, as in the full prompts; the tokens of the prompt
+            # and of the prefix alone can differ where the tokenizer merges across the end of the prefix, so only
+            # the common tokens, and at least one token less than the prompt, are kept
+            prefix_ids = self._chat_inputs(prefix)["input_ids"][0]
+            length = min(_common_length(prefix_ids, ids), len(ids) - 1)
+            if length <= 0:
+                return None
+            with torch.no_grad():
+                past = self.model(input_ids=ids[None, :length], past_key_values=DynamicCache(), use_cache=True).past_key_values
+            self._prefix_cache[key] = (ids[:length], past)
+            while len(self._prefix_cache) > self.MAX_PREFIXES:
+                self._prefix_cache.popitem(last=False)
+        self._prefix_cache.move_to_end(key)
+        prefix_ids, past = self._prefix_cache[key]
+        length = min(_common_length(prefix_ids, ids), len(ids) - 1)
+        if length <= 0:
+            return None
+        # generate extends the cache it is given, so it gets a copy cut to the tokens this prompt shares
+        past = copy.deepcopy(past)
+        if length < len(prefix_ids):
+            past.crop(length)
+        return past
+
+    def _generate(self, prompt, max_new_tokens, temperature, prefix=None, stop=None, fence=False):
+        try:
+            inputs = self._chat_inputs(prompt)
+            # generate only runs the tokens of input_ids that are not in past_key_values yet
+            past_key_values = self._prefix_past(prefix, inputs["input_ids"]) if prefix and prompt.startswith(prefix) else None
+            start = inputs["input_ids"].shape[-1]
+
+            outputs = self.model.generate(
+                **inputs,
+                max_new_tokens=max_new_tokens,
+                temperature=temperature,
+                do_sample=False,
+                pad_token_id=self.tokenizer.eos_token_id,
+                past_key_values=past_key_values,
+                stopping_criteria=StoppingCriteriaList([StopOnStrings(self.tokenizer, start, stop, fence)]) if stop or fence else None
+            )
+
+            return cut_at_stop(self.tokenizer.decode(
+                outputs[0][start:],
+                skip_special_tokens=True
+            ), stop, fence).strip()
+        except Exception as e:
+            print(f"Error generating text: {e}")
+
+    def generate_batch(
+        self,
+        prompts: list,
+        max_new_tokens: int = 3072,
+        temperature: float = 0,
+        batch_size: int = 8,
+        stop: list = None,
+        fence: bool = False,
+    ) -> list:
+        """
+        Answer every prompt of `prompts`, in order, running up to `batch_size` of them through one
+        `model.generate` call. Answers are cached under the same keys as `generate`, so only the prompts
+        never answered before are generated, each distinct prompt once. Batches are prefilled in full: they
+        do not resume from the cached prompt prefixes of `generate`.
+        `stop` and `fence` end each answer as in `generate`.
+        """
+        settings = self._settings(temperature, max_new_tokens, stop, fence)
+        cache = llm_cache()
+        answers = {}
+        if cache is not None:
+            for prompt in set(prompts):
+                answer = cache.get(cache.key(settings, prompt))
+                if answer is not None:
+                    answers[prompt] = answer
+        missing = [prompt for prompt in dict.fromkeys(prompts) if prompt not in answers]
+        for i in range(0, len(missing), batch_size):
+            batch = missing[i:i + batch_size]
+            for prompt, answer in zip(batch, self._generate_batch(batch, max_new_tokens, temperature, stop, fence)):
+                answers[prompt] = answer
+                # failed generations are None and are retried next time
+                if cache is not None and answer is not None:
+                    cache.put(cache.key(settings, prompt), answer)
+        return [answers[prompt] for prompt in prompts]
+
+    def _generate_batch(self, prompts, max_new_tokens, temperature, stop=None, fence=False):
         try:
-            messages = [{"role": "user", "content": prompt}]
-            inputs = self.tokenizer.apply_chat_template(
-                messages,
-                add_generation_prompt=True,
-                tokenize=True,
-                return_dict=True,
+            texts = [
+                self.tokenizer.apply_chat_template(
+                    [{"role": "user", "content": prompt}],
+                    add_generation_prompt=True,
+                    tokenize=False,
+                )
+                for prompt in prompts
+            ]
+            # the chat template already holds the special tokens
+            inputs = self.tokenizer(
+                texts,
+                padding=True,
+                add_special_tokens=False,
                 return_tensors="pt",
             ).to(self.model.device)
 
+            # with left padding every prompt takes the full input width
+            start = inputs["input_ids"].shape[-1]
+
+            # a sequence that reaches its end-of-sequence token or a stop is padded from there on while the
+            # others go on, and the call returns once every sequence has stopped or max_new_tokens are generated
             outputs = self.model.generate(
                 **inputs,
                 max_new_tokens=max_new_tokens,
                 temperature=temperature,
                 do_sample=False,
-                pad_token_id=self.tokenizer.eos_token_id
+                pad_token_id=self.tokenizer.pad_token_id,
+                stopping_criteria=StoppingCriteriaList([StopOnStrings(self.tokenizer, start, stop, fence)]) if stop or fence else None
             )
 
-            return self.tokenizer.decode(
-                outputs[0][inputs["input_ids"].shape[-1]:],
-                skip_special_tokens=True
-            ).strip()
+            return [
+                cut_at_stop(self.tokenizer.decode(output, skip_special_tokens=True), stop, fence).strip()
+                for output in outputs[:, start:]
+            ]
         except Exception as e:
             print(f"Error generating text: {e}")
+            return [None] * len(prompts)
+
+
+def _common_length(a, b):
+    """Number of leading tokens the 1-D tensors `a` and `b` share."""
+    n = min(len(a), len(b))
+    different = (a[:n] != b[:n]).nonzero()
+    return different[0].item() if len(different) else n
 
 
 if __name__ == "__main__":
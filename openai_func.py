@@ -4,23 +4,71 @@ import copy
 import ast
 import math
 import time
+import functools
 
 import numpy as np
 
 import openai
-import anthropic
-from mistralai.client import MistralClient
-from mistralai.models.chat_completion import ChatMessage
 
 from dotenv import load_dotenv
 
+from utils.llm_cache import cached_response
+
 load_dotenv()
 
 claude_api_key_name = os.getenv("CLAUDE_API_KEY")
 mixtral_api_key_name = os.getenv("MISTRAL_API_KEY")
 openai_api_key = os.getenv("OPENAI_API_KEY")
 
+CLAUDE_MODEL = "claude-3-opus-20240229" # claude-3-sonnet-20240229, claude-3-opus-20240229, claude-3-haiku-20240307
+MIXTRAL_MODEL = 'mistral-large-latest'
+
+# Budget for LLM API requests, shared by every process that calls set_llm_budget with the same objects:
+# a semaphore capping the requests in flight and a shared clock spacing their starts to a requests per
+# minute rate. Both are off until set_llm_budget is called.
+_llm_semaphore = None
+_llm_next_slot = None
+_llm_interval = 0.0
+
+def set_llm_budget(semaphore = None, next_slot = None, requests_per_minute = None):
+  """`semaphore` is a multiprocessing semaphore, `next_slot` a multiprocessing.Value('d', 0.0)."""
+  global _llm_semaphore, _llm_next_slot, _llm_interval
+  _llm_semaphore = semaphore
+  _llm_next_slot = next_slot
+  _llm_interval = 60.0 / requests_per_minute if requests_per_minute else 0.0
+
+def _wait_for_slot():
+  if _llm_next_slot is None or _llm_interval <= 0:
+    return
+  with _llm_next_slot.get_lock():
+    now = time.time()
+    start = max(now, _llm_next_slot.value)
+    _llm_next_slot.value = start + _llm_interval
+  time.sleep(start - now)
+
+def _budgeted(func):
+  @functools.wraps(func)
+  def wrapper(*args, **kwargs):
+    _wait_for_slot()
+    if _llm_semaphore is None:
+      return func(*args, **kwargs)
+    with _llm_semaphore:
+      return func(*args, **kwargs)
+  return wrapper
+
 def GPT_response(messages, model_name):
+  # every request runs at temperature 0, so identical requests are answered from the response cache
+  return cached_response(['openai', model_name, "You are a helpful assistant.", 0.0], messages, lambda: _GPT_request(messages, model_name))
+
+def Claude_response(messages):
+  return cached_response(['anthropic', CLAUDE_MODEL, "", 0.0, 4096], messages, lambda: _Claude_request(messages))
+
+def Mixtral_response(messages, mode = 'normal'):
+  # the mode picks the system prompt
+  return cached_response(['mistral', MIXTRAL_MODEL, mode, 0.0], messages, lambda: _Mixtral_request(messages, mode))
+
+@_budgeted
+def _GPT_request(messages, model_name):
   if model_name in ['gpt-4-turbo-preview','gpt-4-1106-preview', 'gpt-4', 'gpt-4o', 'gpt-4-32k', 'gpt-3.5-turbo-0301', 'gpt-4-0613', 'gpt-4-32k-0613', 'gpt-3.5-turbo-16k-0613', 'gpt-3.5-turbo']:
     #print(f'-------------------Model name: {model_name}-------------------')
     response = openai.ChatCompletion.create(
@@ -38,12 +86,14 @@ def GPT_response(messages, model_name):
     
   return response.choices[0].message.content
 
-def Claude_response(messages):
+@_budgeted
+def _Claude_request(messages):
+  import anthropic
   client = anthropic.Anthropic(
     api_key=claude_api_key_name,
   )
   message = client.messages.create(
-    model="claude-3-opus-20240229", # claude-3-sonnet-20240229, claude-3-opus-20240229, claude-3-haiku-20240307
+    model=CLAUDE_MODEL,
     max_tokens=4096,
     temperature=0.0,
     system="",
@@ -53,8 +103,11 @@ def Claude_response(messages):
   )
   return message.content[0].text
 
-def Mixtral_response(messages, mode = 'normal'):
-  model = 'mistral-large-latest'
+@_budgeted
+def _Mixtral_request(messages, mode = 'normal'):
+  from mistralai.client import MistralClient
+  from mistralai.models.chat_completion import ChatMessage
+  model = MIXTRAL_MODEL
   client = MistralClient(api_key=mixtral_api_key_name)
 
   if mode == 'json':
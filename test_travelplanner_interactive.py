@@ -30,6 +30,8 @@ from datasets import load_dataset
 import os
 import pdb
 from openai_func import *
+from utils.llm_cache import llm_cache
+from utils.solver_program import SolverProgram
 import json
 from z3 import *
 from tools.cities.apis import *
@@ -380,7 +382,7 @@ def pipeline(query, mode, user_mode, index):
     suggestions = []
     for i in range(10):
         local_vars = locals()
-        exec(codes, globals(), local_vars)
+        SolverProgram([('codes', codes)]).run(globals(), local_vars)
         if os.path.exists(path+'plans/' + 'plan.txt'):
             print('Found plan')
             break
@@ -498,7 +500,7 @@ def collect_inital_codes(query, mode, index, model_version = None):
             codes += f.read()
         f.close()
         local_vars = locals()
-        exec(codes, globals(), local_vars)
+        SolverProgram([('codes', codes)]).run(globals(), local_vars)
         with open(path+'codes/' + 'codes.txt', 'w') as f:
             f.write(codes)
         f.close()
@@ -533,7 +535,7 @@ def run_code(mode, user_mode, index):
       codes = f.read()
     f.close()
     local_vars = locals()
-    exec(codes, globals(), local_vars)
+    SolverProgram([('codes', codes)]).run(globals(), local_vars)
     pdb.set_trace()
 
 
@@ -554,3 +556,5 @@ if __name__ == '__main__':
                 with open(path+'plans/' + 'error.txt', 'w') as f:
                     f.write(str(e))
                 f.close()
+    if llm_cache() is not None:
+        print('LLM response cache:', llm_cache().stats())
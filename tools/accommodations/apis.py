@@ -2,20 +2,52 @@ import pandas as pd
 from pandas import DataFrame
 from typing import Optional
 from utils.func import extract_before_parenthesis
+from utils.database import load_database
+from utils.flat_table import FlatTable, FlatColumn
+from utils.pruning import accommodation_positions
+from utils.interning import first_positions, city_ids, intern_columns
 from z3 import *
 import numpy as np
 
+def _load_accommodations(path):
+    return pd.read_csv(path).dropna()[['NAME','price','room type', 'house_rules', 'minimum nights', 'maximum occupancy', 'review rate number', 'city']]
+
+_TYPES_RULES = ['Private room', 'Entire home/apt', 'Shared room', 'No visitors', 'No smoking', 'No parties', 'No children under 10', 'No pets']
+
+def _type_rule_masks(data):
+    # bit j is set when _TYPES_RULES[j] appears in the room type (j < 3) or in the house rules (j >= 3)
+    room_types = np.zeros(len(data), dtype=np.int64)
+    house_rules = np.zeros(len(data), dtype=np.int64)
+    for j, name in enumerate(_TYPES_RULES):
+        if j < 3:
+            room_types |= data['room type'].str.contains(name, regex=False).to_numpy(dtype=np.int64) << j
+        else:
+            house_rules |= data['house_rules'].str.contains(name, regex=False).to_numpy(dtype=np.int64) << j
+    return {'room_types': room_types, 'house_rules': house_rules}
+
+def _intern_accommodations(data):
+    return intern_columns(data, {'city': city_ids})
+
 class Accommodations:
-    def __init__(self, path="TravelPlanner_database/accommodations/clean_accommodations_2022.csv"):
+    def __init__(self, path="TravelPlanner_database/accommodations/clean_accommodations_2022.csv", encoding="array"):
         self.path = path
-        self.data = pd.read_csv(self.path).dropna()[['NAME','price','room type', 'house_rules', 'minimum nights', 'maximum occupancy', 'review rate number', 'city']]
+        self.pruning = None
+        # the candidate rows of every city the solver code encoded, and the city list it was given, so that
+        # the model is decoded against the rows its indices refer to
+        self.encoded = {}
+        self.all_cities = None
+        # "array" builds nested Z3 Store terms, "flat" builds FlatTable If-chains over the candidate rows
+        self.encoding = encoding
+        self.data = load_database('TravelPlanner', 'accommodations', self.path, _load_accommodations, cache=True, prepare=_intern_accommodations)
+        self.masks = load_database('TravelPlanner', 'accommodations_masks', self.path, lambda path: _type_rule_masks(self.data), cache=True)
         print("Accommodations loaded.")
 
     def load_db(self):
-        self.data = pd.read_csv(self.path).dropna()
+        self.data = _intern_accommodations(pd.read_csv(self.path).dropna())
+        self.masks = _type_rule_masks(self.data)
     
     def run_search(self, city):
-        results = self.data[self.data["city"] == city]
+        results = self.data[self.data['city'] == city]
         if len(results) == 0:
             return "There is no accommodation in this city."
         
@@ -41,23 +73,58 @@ class Accommodations:
             city: str,
             ) -> DataFrame:
         """Search for accommodations by city."""
-        results = self.data[self.data["city"] == city]
+        results = self.data[self.data['city'] == city]
         if len(results) == 0:
             return "There is no attraction in this city."
         
         return results
     
 
+    def set_pruning(self, query):
+        """Encode only the non-dominated listings for `query` (the query JSON), or every listing when it is None."""
+        self.pruning = query
+        self.encoded = {}
+
+    def city_positions(self, city_id):
+        """Return the table positions of the listings in the city with interned id `city_id`."""
+        return np.flatnonzero(self.data['city'].cat.codes.to_numpy() == city_id)
+
+    def candidate_positions(self, city):
+        """Return the table positions of the listings the solver encodes for `city`."""
+        positions = self.city_positions(city_ids.id(city))
+        if self.pruning is None or len(positions) == 0:
+            return positions
+        kept = accommodation_positions(self.data['price'].to_numpy()[positions], self.data['minimum nights'].to_numpy()[positions],
+                                       self.data['maximum occupancy'].to_numpy()[positions], self.masks['room_types'][positions],
+                                       self.masks['house_rules'][positions], self.pruning)
+        return positions[kept]
+
+    def candidates(self, city):
+        """Return the listings the solver encodes for `city`; model indices refer to these rows."""
+        return self.data.iloc[self.candidate_positions(city)]
+
+    def encoded_candidates(self, city):
+        """Return the listings encoded for `city`, looking them up only for a city the solver code did not encode."""
+        rows = self.encoded.get(city)
+        if rows is None:
+            return self.candidates(city)
+        return rows
+
     def run_for_all_cities(self, all_cities: list,
             cities: list,
             ) -> DataFrame:
         """Search for flights by origin, destination, and departure date."""
-        types_rule_list = ['Private room', 'Entire home/apt', 'Shared room', 'No visitors', 'No smoking', 'No parties', 'No children under 10', 'No pets']
+        self.all_cities = list(all_cities)
+        if self.encoding == 'flat':
+            return self.run_for_all_cities_flat(all_cities, cities)
+        city_index = first_positions(all_cities)
         results = Array('accommodations', IntSort(), IntSort(), ArraySort(IntSort(), IntSort())) # ori, dest, date, [Price, DepTime, ArrTime], info
         # results_hard_constraint = Array('accommodations hard constraint', IntSort(), StringSort(), ArraySort(IntSort(), IntSort(), BoolSort())) # ori, dest, date, [Price, DepTime, ArrTime], info
-        results_hard_constraint = Array('accommodations hard constraint', IntSort(), IntSort(), ArraySort(IntSort(), IntSort(), BoolSort())) # ori, dest, date, [Price, DepTime, ArrTime], info
+        results_hard_constraint = Array('accommodations hard constraint', IntSort(), IntSort(), ArraySort(IntSort(), BitVecSort(8))) # ori, dest, date, [Price, DepTime, ArrTime], info
         for i, city in enumerate(cities):
-            result = self.data[self.data["city"] == city]
+            positions = self.candidate_positions(city)
+            result = self.data.iloc[positions]
+            self.encoded[city] = result
             if len(result) != 0:
                 # print('accommodations',city, len(result), len(np.array(result)[:,1]), np.array(result)[:,2], np.array(result)[:,3])
                 # print('accommodations',city)                
@@ -65,47 +132,68 @@ class Accommodations:
                 price = Array('Price', IntSort(), IntSort())
                 minimum_nights = Array('Minimum_nights', IntSort(), IntSort())
                 maximum_occupancy = Array('Maximum_occupancy', IntSort(), IntSort())
-                room_types = Array('Room_types', IntSort(), IntSort(), BoolSort())
-                house_rules = Array('House_rules', IntSort(), IntSort(), BoolSort())
+                room_types = Array('Room_types', IntSort(), BitVecSort(8))
+                house_rules = Array('House_rules', IntSort(), BitVecSort(8))
+                room_types_masks = self.masks['room_types'][positions]
+                house_rules_masks = self.masks['house_rules'][positions]
                 length = Array('Length', IntSort(), IntSort())
-                length = Store(length, 0, len(np.array(result)[:,1]))
+                rows = np.array(result)
+                length = Store(length, 0, len(rows[:,1]))
                 # import pdb; pdb.set_trace()
-                for index in range(np.array(result).shape[0]):
-                    if np.array(result)[:,1][index] is not np.nan:
-                        price = Store(price, index, np.array(result)[:,1][index])
+                for index in range(rows.shape[0]):
+                    if rows[:,1][index] is not np.nan:
+                        price = Store(price, index, rows[:,1][index])
                     else:
                         price = 0 #TODO
-                    if np.array(result)[:,4][index] is not np.nan:
-                        minimum_nights = Store(minimum_nights, index, np.array(result)[:,4][index])
+                    if rows[:,4][index] is not np.nan:
+                        minimum_nights = Store(minimum_nights, index, rows[:,4][index])
                     else:
                         minimum_nights = Store(minimum_nights, index, 0)
-                    if np.array(result)[:,5][index] is not np.nan:
-                        maximum_occupancy = Store(maximum_occupancy, index, np.array(result)[:,5][index])
+                    if rows[:,5][index] is not np.nan:
+                        maximum_occupancy = Store(maximum_occupancy, index, rows[:,5][index])
                     else:
                         maximum_occupancy = 10 #TODO
-                    room_types_list = np.array(result)[:,2][index]
-                    house_rules_list = np.array(result)[:,3][index]
-                    # print(room_types_list)
-                    # print(house_rules_list)
-                    for j in range(3):
-                        # print(types_rule_list[j] in room_types_list)
-                        room_types = Store(room_types, index, j, types_rule_list[j] in room_types_list)
-                    for j in range(3,8):
-                        house_rules = Store(house_rules, index, j, types_rule_list[j] in house_rules_list)
-                results = Store(results, all_cities.index(city), 0, price)
-                results = Store(results, all_cities.index(city), 1, minimum_nights)
-                results = Store(results, all_cities.index(city), 2, maximum_occupancy)
-                results = Store(results, all_cities.index(city), 3, length)
-                results_hard_constraint = Store(results_hard_constraint, all_cities.index(city), 0, room_types)
-                results_hard_constraint = Store(results_hard_constraint, all_cities.index(city), 1, house_rules)
+                    room_types = Store(room_types, index, BitVecVal(int(room_types_masks[index]), 8))
+                    house_rules = Store(house_rules, index, BitVecVal(int(house_rules_masks[index]), 8))
+                results = Store(results, city_index[city], 0, price)
+                results = Store(results, city_index[city], 1, minimum_nights)
+                results = Store(results, city_index[city], 2, maximum_occupancy)
+                results = Store(results, city_index[city], 3, length)
+                results_hard_constraint = Store(results_hard_constraint, city_index[city], 0, room_types)
+                results_hard_constraint = Store(results_hard_constraint, city_index[city], 1, house_rules)
             else:
                 length = Array('Length', IntSort(), IntSort())
                 length = Store(length, 0, -1)
-                results = Store(results, all_cities.index(city), 3, length)
+                results = Store(results, city_index[city], 3, length)
         return results, results_hard_constraint
 
+    def run_for_all_cities_flat(self, all_cities: list, cities: list):
+        """Flat counterpart of run_for_all_cities: one FlatTable holding both the info and the hard constraint columns."""
+        city_index = first_positions(all_cities)
+        table = FlatTable('accommodations', {'Price': IntSort(), 'Minimum_nights': IntSort(), 'Maximum_occupancy': IntSort(), 'Length': IntSort(),
+                                             'Room_types': BitVecSort(8), 'House_rules': BitVecSort(8)})
+        for city in cities:
+            positions = self.candidate_positions(city)
+            if len(positions) == 0:
+                table.add((city_index[city],), Length=[-1])
+                continue
+            result = self.data.iloc[positions]
+            self.encoded[city] = result
+            table.add((city_index[city],),
+                      Price=result['price'].tolist(),
+                      Minimum_nights=result['minimum nights'].tolist(),
+                      Maximum_occupancy=result['maximum occupancy'].tolist(),
+                      Length=[len(positions)],
+                      Room_types=self.masks['room_types'][positions].tolist(),
+                      House_rules=self.masks['house_rules'][positions].tolist())
+        return table, table
+
     def get_info(self, info, i, key):
         # ['Price', 'Minimum_nights', 'Maximum_occupancy', 'Length']
+        if isinstance(info, FlatTable):
+            if key == 'Room_types' or key == 'House_rules':
+                return info.column((i,), key), None
+            return info.column((i,), key), info.length((i,))
         if key == 'Room_types' or key == 'House_rules':
             if key == 'Room_types':
                 info_key = Select(info, i, 0)
@@ -120,16 +208,22 @@ class Accommodations:
             return info_key, length
     
     def get_info_for_index(self, price_list, index):
+        if isinstance(price_list, FlatColumn):
+            return price_list.select(index)
         return Select(price_list, index)
 
     def check_exists(self, type, accommodation_list, index):
-        types_rule_list = ['Private room', 'Entire home/apt', 'Shared room', 'No visitors', 'No smoking', 'No parties', 'No children under 10', 'No pets']
-        exists = Select(accommodation_list, index, types_rule_list.index(type))
+        # room types and house rules are bitmasks, with the bit of each name at its position in _TYPES_RULES
+        bit = _TYPES_RULES.index(type)
+        if isinstance(accommodation_list, FlatColumn):
+            exists = accommodation_list.any(lambda mask: mask >> bit & 1, index)
+        else:
+            exists = Extract(bit, bit, Select(accommodation_list, index)) == 1
         return If(index != -1, exists, False)
     
     def run_for_annotation(self,
             city: str,
             ) -> DataFrame:
         """Search for accommodations by city."""
-        results = self.data[self.data["city"] == extract_before_parenthesis(city)]
+        results = self.data[self.data['city'] == extract_before_parenthesis(city)]
         return results
\ No newline at end of file
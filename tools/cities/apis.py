@@ -3,22 +3,57 @@ from tools.accommodations.apis import *
 from tools.restaurants.apis import *
 from tools.googleDistanceMatrix.apis import *
 from tools.flights.apis import *
+from tools.flights.apis import _load_flights, _intern_flights
+from tools.googleDistanceMatrix.apis import _intern_distances
+from tools.googleDistanceMatrix.apis import extract_before_parenthesis
+from utils.database import load_database
+import pandas as pd
+
+def _load_city_states(path):
+    cityStateMapping = open(path, "r").read().strip().split("\n")
+    data = {}
+    for unit in cityStateMapping:
+        city, state = unit.split("\t")
+        if state not in data:
+            data[state] = [city]
+        else:
+            data[state].append(city)
+    return data
+
+def _index_flight_routes(data):
+    # the destinations served from every (origin, date)
+    return {key: set(destinations) for key, destinations in data.groupby(['OriginCityName', 'FlightDate'], sort=False, observed=True)['DestCityName'].unique().items()}
+
+def _index_undrivable(data):
+    # per origin, the destinations whose distance row (the first one) has no duration or distance, or takes
+    # a day or more; a pair without any row has always been reported as drivable and still is
+    first = data.drop_duplicates(['origin', 'destination'])
+    invalid = first['duration'].isna() | first['distance'].isna() | first['duration'].astype(str).str.contains('day', regex=False)
+    index = {}
+    for origin, destination in zip(first['origin'][invalid], first['destination'][invalid]):
+        index.setdefault(origin, set()).add(destination)
+    return index
 
 class Cities:
-    def __init__(self ,path="TravelPlanner_database/background/citySet_with_states.txt") -> None:
+    def __init__(self ,path="TravelPlanner_database/background/citySet_with_states.txt", flights_path="TravelPlanner_database/flights/clean_Flights_2022.csv", distance_path="TravelPlanner_database/googleDistanceMatrix/distance.csv") -> None:
         self.path = path
+        self.flights_path = flights_path
+        self.distance_path = distance_path
+        # reachability indexes over the flight and distance tables, loaded by the first run
+        self.flight_routes = None
+        self.undrivable = None
         self.load_data()
         print("Cities loaded.")
 
     def load_data(self):
-        cityStateMapping = open(self.path, "r").read().strip().split("\n")
-        self.data = {}
-        for unit in cityStateMapping:
-            city, state = unit.split("\t")
-            if state not in self.data:
-                self.data[state] = [city]
-            else:
-                self.data[state].append(city)
+        self.data = load_database('TravelPlanner', 'cities', self.path, _load_city_states)
+
+    def load_reachability(self):
+        """Load the indexes run checks flight and driving reachability against, shared by the whole process."""
+        self.flight_routes = load_database('TravelPlanner', 'flight_routes', self.flights_path,
+                                           lambda path: _index_flight_routes(load_database('TravelPlanner', 'flights', path, _load_flights, cache=True, prepare=_intern_flights)), cache=True)
+        self.undrivable = load_database('TravelPlanner', 'undrivable', self.distance_path,
+                                        lambda path: _index_undrivable(load_database('TravelPlanner', 'distance', path, pd.read_csv, cache=True, prepare=_intern_distances)), cache=True)
     
     def run(self, state, origin, dates) -> dict:
         if state not in self.data:
@@ -27,16 +62,14 @@ class Cities:
         else:
             city_list = self.data[state]
             # print(city_list)
-            AccommodationSearch = Accommodations()
-            RestaurantSearch = Restaurants()
-            FlightSearch = Flights()
-            DistanceSearch = GoogleDistanceMatrix()
+            if self.flight_routes is None:
+                self.load_reachability()
+            flights = self.flight_routes.get((origin, dates[0]), set())
+            undrivable = self.undrivable.get(extract_before_parenthesis(origin), set())
             good = []
             bad = []
             for city in city_list:
-                flight = FlightSearch.run(origin, city, dates[0])
-                drive = DistanceSearch.run(origin, city)
-                if not 'no flight' in flight or not 'No valid information' in drive:
+                if city in flights or extract_before_parenthesis(city) not in undrivable:
                     good.append(city)
                 else:
                     bad.append(city)
@@ -1,5 +1,8 @@
 import requests
 from utils.func import extract_before_parenthesis
+from utils.database import load_database
+from utils.legs import city_legs
+from utils.interning import first_positions, city_ids, intern_columns
 import os
 from requests.exceptions import SSLError
 import time
@@ -10,16 +13,74 @@ from z3 import *
 import copy
 import math
 
+def _convert_time(time):
+    # "H hours M mins" -> float hours
+    if 'hours' in time:
+        hour = time.split(' hours')[0]
+        time = time.split(' hours')[1][1:]
+    elif 'hour' in time:
+        hour = time.split(' hour')[0]
+        time = time.split(' hour')[1][1:]
+    else:
+        hour = 0
+    if 'mins' in time:
+        minute = time.split(' mins')[0]
+    elif 'min' in time:
+        minute = time.split(' min')[0]
+    else:
+        minute = 0
+    return int(hour) + float(minute)/60
+
+def _index_distances(data):
+    # dense (origin, destination) arrays over every city of the table, all read from the first row of a pair:
+    # its position (-1 when there is none), whether it gives both a duration and a distance, whether the
+    # duration runs into days, and the duration in hours and the distance in km as numbers
+    cities = sorted(set(data['origin']) | set(data['destination']))
+    codes = {city: code for code, city in enumerate(cities)}
+    shape = (len(cities), len(cities))
+    index = {'codes': codes, 'row': np.full(shape, -1, dtype=np.int64), 'valid': np.zeros(shape, dtype=bool),
+             'day': np.zeros(shape, dtype=bool), 'hours': np.full(shape, np.nan), 'km': np.full(shape, np.nan)}
+    positions = np.flatnonzero(~data.duplicated(['origin', 'destination']).to_numpy())
+    pairs = tuple(np.array([codes[city] for city in data[column].to_numpy()[positions]], dtype=np.int64) for column in ['origin', 'destination'])
+    duration = data['duration'].to_numpy()[positions]
+    distance = data['distance'].to_numpy()[positions]
+    valid = ~(pd.isna(duration) | pd.isna(distance))
+    index['row'][pairs] = positions
+    index['valid'][pairs] = valid
+    given = (pairs[0][valid], pairs[1][valid])
+    day = np.array(['day' in text for text in duration[valid]], dtype=bool)
+    index['day'][given] = day
+    index['km'][given] = pd.to_numeric(pd.Series(distance[valid], dtype=object).str.replace('km', '').str.replace(',', ''), errors='coerce').to_numpy(dtype=float)
+    index['hours'][(given[0][~day], given[1][~day])] = [_convert_time(text) for text in duration[valid][~day]]
+    return index
+
+def _intern_distances(data):
+    return intern_columns(data, {'origin': city_ids, 'destination': city_ids})
+
 class GoogleDistanceMatrix:
-    def __init__(self, subscription_key: str="") -> None:
+    def __init__(self, subscription_key: str="", path="TravelPlanner_database/googleDistanceMatrix/distance.csv") -> None:
         self.gplaces_api_key: str = subscription_key
-        self.data =  pd.read_csv('TravelPlanner_database/googleDistanceMatrix/distance.csv')
+        self.path = path
+        # the city list the solver code was given
+        self.all_cities = None
+        self.data =  load_database('TravelPlanner', 'distance', self.path, pd.read_csv, cache=True, prepare=_intern_distances)
+        self.index = load_database('TravelPlanner', 'distance_index', self.path, lambda path: _index_distances(self.data), cache=True)
         print("GoogleDistanceMatrix loaded.")
 
+    def lookup(self, origin, destination):
+        """Return the position of the (origin, destination) pair in the arrays of self.index, or None when the table has no row for it."""
+        codes = self.index['codes']
+        if origin not in codes or destination not in codes:
+            return None
+        pair = (codes[origin], codes[destination])
+        if self.index['row'][pair] == -1:
+            return None
+        return pair
+
     def run_check(self, origin, destination):
-        response = self.data[(self.data['origin'] == origin) & (self.data['destination'] == destination)]
-        if len(response) > 0:
-            if response['duration'].values[0] is None or response['distance'].values[0] is None or response['duration'].values[0] is np.nan or response['distance'].values[0] is np.nan:
+        pair = self.lookup(origin, destination)
+        if pair is not None:
+            if not self.index['valid'][pair]:
                     return f'Driving is not feasible from {origin} to {destination}'
             else:
                 return f'Driving exists from {origin} to {destination}'
@@ -27,7 +88,7 @@ class GoogleDistanceMatrix:
             return f'Driving is not feasible from {origin} to {destination}'
     
     def run_search(self, origin):
-        response = self.data[(self.data['origin'] == origin)]
+        response = self.data[self.data['origin'] == origin]
         if len(response) > 0:
             return np.unique(np.array(response['destination']))
         else:
@@ -37,17 +98,17 @@ class GoogleDistanceMatrix:
         origin = extract_before_parenthesis(origin)
         destination = extract_before_parenthesis(destination)
         info = {"origin": origin, "destination": destination,"cost": None, "duration": None, "distance": None}
-        response = self.data[(self.data['origin'] == origin) & (self.data['destination'] == destination)]
-        if len(response) > 0:
-                if response['duration'].values[0] is None or response['distance'].values[0] is None or response['duration'].values[0] is np.nan or response['distance'].values[0] is np.nan:
+        pair = self.lookup(origin, destination)
+        if pair is not None:
+                if not self.index['valid'][pair]:
                     return "No valid information."
-                info["duration"] = response['duration'].values[0]
-                info["distance"] = response['distance'].values[0]
+                info["duration"] = self.data['duration'].values[self.index['row'][pair]]
+                info["distance"] = self.data['distance'].values[self.index['row'][pair]]
                 if 'driving' in mode:
-                    info["cost"] = int(eval(info["distance"].replace("km","").replace(",","")) * 0.05)
+                    info["cost"] = int(self.index['km'][pair] * 0.05)
                 elif mode == "taxi":
-                    info["cost"] = int(eval(info["distance"].replace("km","").replace(",","")))
-                if 'day' in info["duration"]:
+                    info["cost"] = int(self.index['km'][pair])
+                if self.index['day'][pair]:
                     return "No valid information."
                 return f"{mode}, from {origin} to {destination}, duration: {info['duration']}, distance: {info['distance']}, cost: {info['cost']}"
 
@@ -57,18 +118,18 @@ class GoogleDistanceMatrix:
         origin = extract_before_parenthesis(origin)
         destination = extract_before_parenthesis(destination)
         info = {"origin": origin, "destination": destination,"cost": None, "duration": None, "distance": None}
-        response = self.data[(self.data['origin'] == origin) & (self.data['destination'] == destination)]
-        if len(response) > 0:
-                if response['duration'].values[0] is None or response['distance'].values[0] is None or response['duration'].values[0] is np.nan or response['distance'].values[0] is np.nan:
+        pair = self.lookup(origin, destination)
+        if pair is not None:
+                if not self.index['valid'][pair]:
                     return info
-                info["duration"] = response['duration'].values[0]
-                info["distance"] = response['distance'].values[0]
+                info["duration"] = self.data['duration'].values[self.index['row'][pair]]
+                info["distance"] = self.data['distance'].values[self.index['row'][pair]]
 
-                if 'day' not in info["duration"]:
+                if not self.index['day'][pair]:
                     if 'driving' in mode:
-                        info["cost"] = int(eval(info["distance"].replace("km","").replace(",","")) * 0.05)
+                        info["cost"] = int(self.index['km'][pair] * 0.05)
                     elif mode == "taxi":
-                        info["cost"] = int(eval(info["distance"].replace("km","").replace(",","")))
+                        info["cost"] = int(self.index['km'][pair])
 
                 return info
 
@@ -140,49 +201,24 @@ class GoogleDistanceMatrix:
     
     def run_for_all_cities(self, origin, all_cities, cities_list):
         """Search for flights by origin, destination, and departure date."""
-        def convert_time(time):
-            # import pdb; pdb.set_trace()
-            if 'hours' in time:
-                hour = time.split(' hours')[0]
-                time = time.split(' hours')[1][1:]
-            elif 'hour' in time:
-                hour = time.split(' hour')[0]
-                time = time.split(' hour')[1][1:]
-            else:
-                hour = 0
-            if 'mins' in time:
-                minute = time.split(' mins')[0]
-            elif 'min' in time:
-                minute = time.split(' min')[0]
-            else:
-                minute = 0
-            # output.append(int(hour) + float(minute)/60)
-            return int(hour) + float(minute)/60
-            # except:
-            #     import pdb; pdb.set_trace()
-        def convert_distance(distance):
-            return float(distance.replace("km","").replace(",",""))
         cities = copy.deepcopy(cities_list)
         cities.insert(0, origin)
+        self.all_cities = list(all_cities)
         all_cities = copy.deepcopy(all_cities)
         all_cities.insert(0, origin)
+        city_index = first_positions(all_cities)
         results = Array('driving', IntSort(), IntSort(), IntSort(), RealSort()) # ori, dest, date, [Price, DepTime, ArrTime], info
-        for i, ori in enumerate(cities):
-            if i!= len(cities)-1:
-                destination = cities[i+1]
-            else:
-                destination = cities[0]
-            result = self.data[self.data["origin"] == ori]
-            result = result[result["destination"] == destination]
-            if len(result) != 0 and (type(np.array(result)[0][3])==str or not math.isnan(np.array(result)[0][3])) and 'day' not in np.array(result)[0][3]:
-                duration = convert_time(np.array(result)[0][3]) # set it to start driving from 6 am?
-                distance = convert_distance(np.array(result)[0][4])
-                results = Store(results, all_cities.index(ori), all_cities.index(destination), 0, distance)
-                results = Store(results, all_cities.index(ori), all_cities.index(destination), 1, duration)
-                results = Store(results, all_cities.index(ori), all_cities.index(destination), 2, distance * 0.05)
-                results = Store(results, all_cities.index(ori), all_cities.index(destination), 3, 1)
+        for ori, destination in city_legs(cities):
+            pair = self.lookup(ori, destination)
+            if pair is not None and self.index['valid'][pair] and not self.index['day'][pair]:
+                duration = self.index['hours'][pair] # set it to start driving from 6 am?
+                distance = self.index['km'][pair]
+                results = Store(results, city_index[ori], city_index[destination], 0, distance)
+                results = Store(results, city_index[ori], city_index[destination], 1, duration)
+                results = Store(results, city_index[ori], city_index[destination], 2, distance * 0.05)
+                results = Store(results, city_index[ori], city_index[destination], 3, 1)
             else:
-                results = Store(results, all_cities.index(ori), all_cities.index(destination), 3, -1)
+                results = Store(results, city_index[ori], city_index[destination], 3, -1)
         return results
     
     def get_info(self, info, i, j, key):
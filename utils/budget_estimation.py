@@ -5,7 +5,7 @@ from tools.googleDistanceMatrix.apis import GoogleDistanceMatrix
 import pandas as pd
 
 hotel = Accommodations()
-flight = Flights()
+flight = Flights(mmap=False)
 flight.load_db()
 restaurant = Restaurants()
 distanceMatrix = GoogleDistanceMatrix()
@@ -0,0 +1,119 @@
+import os
+import json
+import pickle
+import shutil
+
+import numpy as np
+
+# Process-wide registry of loaded database tables, keyed by (flavor, table name, absolute path).
+# Every tool instance of the same flavor gets the same frame, so callers must treat it as read-only.
+_databases = {}
+
+# Parsed tables are also kept on disk next to their source file, in a binary form that loads
+# much faster than the CSV. Set TRAVEL_DB_CACHE=0 to always parse the CSV.
+DISK_CACHE = os.environ.get('TRAVEL_DB_CACHE', '1') != '0'
+CACHE_DIR = '__dbcache__'
+# Bump when a loader changes the shape of the table it returns, so stale caches are rebuilt.
+CACHE_VERSION = 1
+# Serve the flights table from memory-mapped column files, so that worker processes share one
+# physical copy of it through the page cache. Set TRAVEL_DB_MMAP=1 to make it the default.
+MMAP_FLIGHTS = os.environ.get('TRAVEL_DB_MMAP', '0') == '1'
+
+
+def load_database(flavor, name, path, loader, cache=False, prepare=None):
+    """
+    Return the table `name` of the `flavor` database ('TravelPlanner' or 'TripCraft') stored at `path`.
+    The table is read with `loader(path)` the first time it is requested and shared afterwards.
+    With `cache=True` the loaded table is also stored on disk and reused by later processes
+    until the source file changes.
+    `prepare(table)` turns the loaded table, read or cached, into the one shared in this process; it is
+    for state that only holds inside one process, such as the interned columns of utils.interning, so
+    every request of a table must pass the same `prepare`.
+    """
+    key = (flavor, name, os.path.abspath(path))
+    if key not in _databases:
+        if cache and DISK_CACHE:
+            table = _load_cached(flavor, name, path, loader)
+        else:
+            table = loader(path)
+        _databases[key] = table if prepare is None else prepare(table)
+    return _databases[key]
+
+
+def load_arrays(flavor, name, path, builder):
+    """
+    Return `(arrays, meta)` for the columnar table `name` derived from the source file at `path`.
+    `builder(path)` returns a dict of NumPy arrays and a JSON-serialisable dict of metadata; they are
+    written once to the disk cache and every process then opens the arrays read-only with mmap.
+    """
+    key = (flavor, name, os.path.abspath(path))
+    if key not in _databases:
+        _databases[key] = _load_mapped(_cache_path(flavor, name, path, extension=''), path, builder)
+    return _databases[key]
+
+
+def clear_databases():
+    """Drop every loaded table so that the next request reads it again."""
+    _databases.clear()
+
+
+def _cache_path(flavor, name, path, extension='.pkl'):
+    directory, filename = os.path.split(os.path.abspath(path))
+    return os.path.join(directory, CACHE_DIR, '{}_{}_{}{}'.format(flavor, name, os.path.splitext(filename)[0], extension))
+
+
+def _source_stamp(path):
+    stat = os.stat(path)
+    return (CACHE_VERSION, stat.st_mtime_ns, stat.st_size)
+
+
+def _load_cached(flavor, name, path, loader):
+    cache_path = _cache_path(flavor, name, path)
+    stamp = _source_stamp(path)
+    if os.path.exists(cache_path):
+        try:
+            with open(cache_path, 'rb') as f:
+                cached_stamp, table = pickle.load(f)
+            if cached_stamp == stamp:
+                return table
+        except Exception as e:
+            print(f"Ignoring unreadable database cache {cache_path}: {e}")
+    table = loader(path)
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        # write to a private file first so concurrent workers never read a partial cache
+        tmp_path = '{}.{}.tmp'.format(cache_path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            pickle.dump((stamp, table), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        print(f"Could not write database cache {cache_path}: {e}")
+    return table
+
+
+def _load_mapped(directory, path, builder):
+    stamp = list(_source_stamp(path))
+    meta_path = os.path.join(directory, 'meta.json')
+    if os.path.exists(meta_path):
+        with open(meta_path, 'r') as f:
+            stored = json.load(f)
+        if stored['stamp'] == stamp:
+            arrays = {column: np.load(os.path.join(directory, column + '.npy'), mmap_mode='r') for column in stored['columns']}
+            return arrays, stored['meta']
+    arrays, meta = builder(path)
+    # build next to the final directory and swap it in, so readers never see a partial layout
+    tmp_directory = '{}.{}.tmp'.format(directory, os.getpid())
+    shutil.rmtree(tmp_directory, ignore_errors=True)
+    os.makedirs(tmp_directory)
+    for column, array in arrays.items():
+        np.save(os.path.join(tmp_directory, column + '.npy'), array)
+    with open(os.path.join(tmp_directory, 'meta.json'), 'w') as f:
+        json.dump({'stamp': stamp, 'columns': list(arrays), 'meta': meta}, f)
+    shutil.rmtree(directory, ignore_errors=True)
+    try:
+        os.replace(tmp_directory, directory)
+    except OSError:
+        # another worker swapped in the same layout first
+        shutil.rmtree(tmp_directory, ignore_errors=True)
+    arrays = {column: np.load(os.path.join(directory, column + '.npy'), mmap_mode='r') for column in arrays}
+    return arrays, meta
@@ -0,0 +1,108 @@
+from z3 import *
+
+
+def _equals(expr, value):
+    # concrete positions are compared in Python so that impossible rows are dropped from the chain
+    if isinstance(expr, int):
+        return expr == value
+    if is_int_value(expr):
+        return expr.as_long() == value
+    return expr == value
+
+
+def _matches(exprs, key):
+    conditions = []
+    for expr, value in zip(exprs, key):
+        condition = _equals(expr, value)
+        if condition is False:
+            return False
+        if condition is not True:
+            conditions.append(condition)
+    if len(conditions) == 0:
+        return True
+    return And(conditions) if len(conditions) > 1 else conditions[0]
+
+
+def _chain(cases, default):
+    # earlier cases take precedence, as in a chain of if / elif
+    result = default
+    for condition, value in reversed(cases):
+        if condition is True:
+            result = value
+        elif condition is not False:
+            result = If(condition, value, result)
+    return result
+
+
+class FlatTable:
+    """
+    Candidate rows of one search, kept as Python lists under the position tuple the array encoding
+    would store them at: (city,) for accommodations and restaurants, (origin, destination, date) for flights.
+    Reading a value builds a finite If-chain over the stored rows instead of a Select on nested Stores;
+    positions that were never stored read as an unconstrained function of the row index, one per column,
+    so that two reads of the same missing row agree, as two Selects on the same array do.
+    """
+
+    def __init__(self, name, sorts):
+        self.name = name
+        self.sorts = sorts
+        self.rows = {}
+        self.defaults = {}
+
+    def add(self, key, **columns):
+        self.rows[key] = columns
+
+    def default(self, name):
+        """Return the function giving the column `name` at rows that were never stored."""
+        if name not in self.defaults:
+            self.defaults[name] = Function(self.name + '_' + name, IntSort(), self.sorts[name])
+        return self.defaults[name]
+
+    def column(self, key, name):
+        """Return the column `name` at the (possibly symbolic) position `key`."""
+        return FlatColumn(self, key, name)
+
+    def length(self, key):
+        """Return the number of candidate rows at `key` (-1 where the search found nothing)."""
+        return self.column(key, 'Length').select(0)
+
+
+class FlatColumn:
+    """One column of a FlatTable at a position, the flat counterpart of the inner Z3 array."""
+
+    def __init__(self, table, key, name):
+        self.table = table
+        self.key = key
+        self.name = name
+
+    def select(self, index):
+        sort = self.table.sorts[self.name]
+        default = self.table.default(self.name)(index)
+        cases = []
+        for key, columns in self.table.rows.items():
+            match = _matches(self.key, key)
+            if match is False or self.name not in columns:
+                continue
+            values = [(_equals(index, row), sort.cast(value)) for row, value in enumerate(columns[self.name])]
+            cases.append((match, _chain(values, default)))
+        return _chain(cases, default)
+
+    def any(self, predicate, index):
+        """Return whether the row at `index` holds a value satisfying `predicate`."""
+        cases = []
+        for key, columns in self.table.rows.items():
+            match = _matches(self.key, key)
+            if match is False or self.name not in columns:
+                continue
+            hits = [_equals(index, row) for row, value in enumerate(columns[self.name]) if predicate(value)]
+            if True in hits:
+                hit = True
+            else:
+                hits = [hit for hit in hits if hit is not False]
+                hit = Or(hits) if len(hits) > 0 else False
+            if hit is False:
+                continue
+            cases.append(hit if match is True else (match if hit is True else And(match, hit)))
+        if True in cases:
+            return BoolVal(True)
+        return Or(cases) if len(cases) > 0 else BoolVal(False)
@@ -0,0 +1,119 @@
+import numpy as np
+import pandas as pd
+
+from utils.database import load_arrays
+
+# columns kept as utf-8 bytes, decoded again when rows are handed out
+_TEXT_COLUMNS = ['Flight Number', 'DepTime', 'ArrTime', 'ActualElapsedTime']
+# columns stored as integer codes into the city / date lists kept in the metadata
+_CODE_COLUMNS = {'OriginCityName': 'cities', 'DestCityName': 'cities', 'FlightDate': 'dates'}
+
+
+def _hours(times):
+    """'HH:MM' strings -> float hours, as the solver encoders use them."""
+    parts = times.str.split(':', expand=True)
+    return (parts[0].astype(int) + parts[1].astype(float) / 60).to_numpy(dtype=np.float64)
+
+
+def _build_flight_arrays(path, loader):
+    data = loader(path)
+    cities = sorted(set(data['OriginCityName']) | set(data['DestCityName']))
+    dates = sorted(set(data['FlightDate']))
+    city_codes = {city: code for code, city in enumerate(cities)}
+    date_codes = {date: code for code, date in enumerate(dates)}
+    origin = data['OriginCityName'].map(city_codes).to_numpy(dtype=np.int64)
+    dest = data['DestCityName'].map(city_codes).to_numpy(dtype=np.int64)
+    date = data['FlightDate'].map(date_codes).to_numpy(dtype=np.int64)
+    # one sortable key per (origin, destination, date); the sort is stable so every group keeps table order
+    key = (origin * len(cities) + dest) * len(dates) + date
+    order = np.argsort(key, kind='stable')
+    arrays = {
+        'key': key[order],
+        'row': data.index.to_numpy()[order],
+        'OriginCityName': origin[order].astype(np.int32),
+        'DestCityName': dest[order].astype(np.int32),
+        'FlightDate': date[order].astype(np.int32),
+        'Price': data['Price'].to_numpy()[order],
+        'Distance': data['Distance'].to_numpy()[order],
+        'dep_hours': _hours(data['DepTime'])[order],
+        'arr_hours': _hours(data['ArrTime'])[order],
+    }
+    for column in _TEXT_COLUMNS:
+        arrays[column] = np.array([value.encode('utf-8') for value in data[column]], dtype=bytes)[order]
+    meta = {'columns': list(data.columns), 'cities': cities, 'dates': dates}
+    return arrays, meta
+
+
+class FlightTable:
+    """
+    Read-only columnar view of a flights table backed by memory-mapped NumPy files.
+    Rows are grouped by (origin, destination, date), so a route lookup is two binary searches and
+    a slice; worker processes opening the same table share its pages instead of each holding a copy.
+    """
+
+    def __init__(self, flavor, path, loader):
+        self.arrays, meta = load_arrays(flavor, 'flights_mmap', path, lambda path: _build_flight_arrays(path, loader))
+        self.columns = meta['columns']
+        self.cities = meta['cities']
+        self.dates = meta['dates']
+        self.city_codes = {city: code for code, city in enumerate(self.cities)}
+        self.date_codes = {date: code for code, date in enumerate(self.dates)}
+
+    def __len__(self):
+        return len(self.arrays['key'])
+
+    def _key(self, origin, destination, departure_date):
+        return (origin * len(self.cities) + destination) * len(self.dates) + departure_date
+
+    def span(self, origin, destination, departure_date):
+        """Return the (start, stop) slice of the flights on one route and date; empty if there are none."""
+        try:
+            key = self._key(self.city_codes[origin], self.city_codes[destination], self.date_codes[departure_date])
+        except KeyError:
+            return 0, 0
+        keys = self.arrays['key']
+        return int(np.searchsorted(keys, key, 'left')), int(np.searchsorted(keys, key, 'right'))
+
+    def leg(self, origin, destination, departure_date):
+        """Return the price, departure hour and arrival hour lists of the flights on one route and date."""
+        start, stop = self.span(origin, destination, departure_date)
+        return (self.arrays['Price'][start:stop].tolist(),
+                self.arrays['dep_hours'][start:stop].tolist(),
+                self.arrays['arr_hours'][start:stop].tolist())
+
+    def destinations(self, origin, departure_date):
+        """Return the sorted unique destinations served from origin on departure date."""
+        if origin not in self.city_codes or departure_date not in self.date_codes:
+            return np.array([], dtype=object)
+        # all routes from one origin are contiguous; filter that block by date
+        block = len(self.cities) * len(self.dates)
+        keys = self.arrays['key']
+        start = int(np.searchsorted(keys, self.city_codes[origin] * block, 'left'))
+        stop = int(np.searchsorted(keys, (self.city_codes[origin] + 1) * block, 'left'))
+        dest = self.arrays['DestCityName'][start:stop][self.arrays['FlightDate'][start:stop] == self.date_codes[departure_date]]
+        return np.array([self.cities[code] for code in np.unique(dest)], dtype=object)
+
+    def rows(self, start, stop):
+        """Rebuild the pandas rows [start, stop) with the columns and index labels of the source table."""
+        frame = {}
+        for column in self.columns:
+            values = self.arrays[column][start:stop]
+            # text goes back as plain lists so pandas infers the same string dtype as read_csv
+            if column in _TEXT_COLUMNS:
+                values = [value.decode('utf-8') for value in values]
+            elif column in _CODE_COLUMNS:
+                names = self.cities if _CODE_COLUMNS[column] == 'cities' else self.dates
+                values = [names[code] for code in values]
+            else:
+                values = np.array(values)
+            frame[column] = values
+        return pd.DataFrame(frame, index=pd.Index(np.array(self.arrays['row'][start:stop])), columns=self.columns)
+
+    def lookup(self, origin, destination, departure_date):
+        """Return the flights on one route and date as a DataFrame, in source table order."""
+        return self.rows(*self.span(origin, destination, departure_date))
+
+    def frame(self):
+        """Materialise the whole table in source order, for callers that scan every flight."""
+        frame = self.rows(0, len(self))
+        return frame.sort_index(kind='stable')
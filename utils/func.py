@@ -1,6 +1,5 @@
 import json
 import re
-import gradio as gr
 import os
 
 def load_line_json_data(filename):
@@ -59,6 +58,8 @@ def judge_valid_info(info):
     return True
 
 def judge_submit_info(info, current_day, label, annotation_data, *tested_data):
+    # gradio is only needed by the annotation UI; importing it here keeps it out of every tool import
+    import gradio as gr
     if info == "" or not info:
         raise gr.Error("Day {} {} is empty!".format(current_day, label))
     if info != "-":
@@ -0,0 +1,69 @@
+import threading
+
+import numpy as np
+import pandas as pd
+
+# Process-wide integer ids for city names and dates, shared by the TravelPlanner and TripCraft tools.
+# Ids are handed out in first-seen order, so they only mean something inside one process and are
+# never written to the disk cache. Tables store their city and date columns as pandas Categoricals
+# over these values (see intern_columns): the rows still read as strings, each value is kept once,
+# and the code of a row is the id of its value.
+
+
+class Interner:
+    """Two-way map between values and small consecutive integer ids."""
+
+    def __init__(self):
+        self.ids = {}
+        self.values = []
+        # tools of several threads may load their tables at the same time
+        self.lock = threading.Lock()
+
+    def intern(self, value):
+        """Return the id of `value`, handing out the next one the first time it is seen."""
+        with self.lock:
+            if value not in self.ids:
+                self.ids[value] = len(self.values)
+                self.values.append(value)
+            return self.ids[value]
+
+    def id(self, value):
+        """Return the id of `value`, or -1 (the code of a missing value) when it was never interned."""
+        return self.ids.get(value, -1)
+
+    def value(self, id):
+        return self.values[id]
+
+    def codes(self, column):
+        """Intern every value of `column` and return their ids as an int32 array, -1 for missing values."""
+        inverse, uniques = pd.factorize(column)
+        ids = np.array([self.intern(value) for value in uniques] + [-1], dtype=np.int32)
+        # factorize marks missing values with -1, which picks the trailing -1
+        return ids[inverse]
+
+    def categories(self):
+        """Return the values interned so far, in id order."""
+        with self.lock:
+            return list(self.values)
+
+
+city_ids = Interner()
+date_ids = Interner()
+
+
+def intern_columns(data, interners):
+    """
+    Store each column of `data` named in `interners` ({column: Interner}) as a Categorical whose categories
+    are the values of its interner, so that its codes are their ids, and return the resulting frame.
+    """
+    codes = {column: interner.codes(data[column]) for column, interner in interners.items()}
+    return data.assign(**{column: pd.Categorical.from_codes(codes[column], categories=interner.categories())
+                          for column, interner in interners.items()})
+
+
+def first_positions(values):
+    """Return {value: position of its first occurrence in `values`}, a dict for repeated values.index(value) calls."""
+    positions = {}
+    for position, value in enumerate(values):
+        positions.setdefault(value, position)
+    return positions
@@ -0,0 +1,6 @@
+def city_legs(cities):
+    """
+    Return the (origin, destination) legs a transport encoder stores. `cities` is the tour with the
+    origin first, visited in order and back to the origin.
+    """
+    return [(ori, cities[(i + 1) % len(cities)]) for i, ori in enumerate(cities)]
@@ -0,0 +1,106 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+# Responses of the deterministic (temperature 0) LLM calls, kept in one SQLite file shared by every
+# process and looked up by a hash of everything that determines the answer. Set LLM_CACHE=0 to always
+# call the model.
+CACHE_ENABLED = os.environ.get('LLM_CACHE', '1') != '0'
+CACHE_PATH = os.environ.get('LLM_CACHE_PATH', os.path.join('__llmcache__', 'responses.sqlite'))
+# Once the stored responses take more than this many bytes the least recently used ones are dropped.
+CACHE_MAX_BYTES = int(os.environ.get('LLM_CACHE_MAX_BYTES', 1 << 30))
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+class LLMCache:
+    """
+    Disk-backed map from request keys to LLM responses with least-recently-used eviction.
+    Hit and miss counts are kept for this process (`hits`, `misses`) and summed over all runs on disk.
+    """
+
+    def __init__(self, path=CACHE_PATH, max_bytes=CACHE_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        # step codes are generated from several threads at once; they share this connection
+        self.lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False, isolation_level=None)
+        with self.lock:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, response TEXT, size INTEGER, used REAL)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER)')
+
+    @staticmethod
+    def key(settings, prompt):
+        """Hash of the request: `settings` is a JSON-serialisable list of model, version, system prompt and sampling options."""
+        return hashlib.sha256(json.dumps([settings, prompt], sort_keys=True).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """Return the cached response for `key`, or None."""
+        with self.lock:
+            row = self.connection.execute('SELECT response FROM responses WHERE key = ?', (key,)).fetchone()
+            name = 'hits' if row is not None else 'misses'
+            if row is not None:
+                self.hits += 1
+                self.connection.execute('UPDATE responses SET used = ? WHERE key = ?', (time.time(), key))
+            else:
+                self.misses += 1
+            self.connection.execute('INSERT INTO stats VALUES (?, 1) ON CONFLICT(name) DO UPDATE SET value = value + 1', (name,))
+        return row[0] if row is not None else None
+
+    def put(self, key, response):
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)', (key, response, len(response.encode('utf-8')), time.time()))
+            self._evict()
+
+    def _evict(self):
+        total = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in self.connection.execute('SELECT key, size FROM responses ORDER BY used').fetchall():
+            if total <= self.max_bytes:
+                break
+            self.connection.execute('DELETE FROM responses WHERE key = ?', (key,))
+            total -= size
+
+    def stats(self):
+        """Return this process's hits and misses, the totals over all runs, and the stored entries and bytes."""
+        with self.lock:
+            totals = dict(self.connection.execute('SELECT name, value FROM stats').fetchall())
+            entries, size = self.connection.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses').fetchone()
+        return {'hits': self.hits, 'misses': self.misses, 'total_hits': totals.get('hits', 0),
+                'total_misses': totals.get('misses', 0), 'entries': entries, 'bytes': size}
+
+
+def llm_cache():
+    """Return the process-wide cache, opened on first use, or None when caching is off."""
+    global _cache
+    if not CACHE_ENABLED:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = LLMCache()
+    return _cache
+
+
+def cached_response(settings, prompt, request):
+    """Return the cached response to `prompt` under `settings`, calling `request()` and storing its answer on a miss."""
+    cache = llm_cache()
+    if cache is None:
+        return request()
+    key = cache.key(settings, prompt)
+    response = cache.get(key)
+    if response is None:
+        response = request()
+        # failed local generations return None; they are retried next time
+        if response is not None:
+            cache.put(key, response)
+    return response
@@ -0,0 +1,112 @@
+import torch
+from transformers import AutoConfig, AutoModelForCausalLM, StoppingCriteria
+
+# Helpers for the local Hugging Face models, shared by LLMWrapper (open_source_models.py) and the TripCraft planner.
+
+QUANTIZATIONS = ["int8", "int4"]
+
+
+class StopOnStrings(StoppingCriteria):
+    """
+    Stops every sequence of a batch on its own once its generated text holds one of `stops`, or, with
+    `fence`, once it has closed the code fence it opened (its second ```). `start` is where generation starts.
+    """
+    # the stops are a few dozen characters at most; the tokens decoded each step to look for them
+    WINDOW = 32
+
+    def __init__(self, tokenizer, start, stops=None, fence=False):
+        self.tokenizer = tokenizer
+        self.start = start
+        self.stops = stops or []
+        self.fence = fence
+
+    def __call__(self, input_ids, scores, **kwargs):
+        done = []
+        for ids in input_ids:
+            generated = ids[self.start:]
+            tail = self.tokenizer.decode(generated[-self.WINDOW:], skip_special_tokens=True)
+            stopped = any(stop in tail for stop in self.stops)
+            # the whole answer is only decoded when a fence may just have been written
+            if not stopped and self.fence and '```' in tail:
+                stopped = self.tokenizer.decode(generated, skip_special_tokens=True).count('```') >= 2
+            done.append(stopped)
+        return torch.tensor(done, dtype=torch.bool, device=input_ids.device)
+
+
+def cut_at_stop(text, stops=None, fence=False):
+    """Cut `text` right after the first of `stops` or, with `fence`, after its closing code fence."""
+    ends = [text.find(stop) + len(stop) for stop in stops or [] if stop in text]
+    if fence:
+        opening = text.find('```')
+        closing = text.find('```', opening + 3) if opening != -1 else -1
+        if closing != -1:
+            ends.append(closing + 3)
+    return text[:min(ends)] if ends else text
+
+
+def check_quantize(quantize, device):
+    """Raise ValueError unless `quantize` is None or one of QUANTIZATIONS on CPU."""
+    if quantize is not None and (quantize not in QUANTIZATIONS or device != "cpu"):
+        raise ValueError(f"quantize must be one of {QUANTIZATIONS}, on CPU only (got {quantize!r} on {device})")
+
+
+def estimate_memory_gb(model_name, quantize=None):
+    """
+    Estimate from the model config the GB of memory the model takes on CPU: (peak while loading, after loading).
+    Weights are loaded in float32 before they are quantized, so the peak is the float32 size either way.
+    """
+    config = AutoConfig.from_pretrained(model_name, trust_remote_code=True)
+    hidden = config.hidden_size
+    heads = config.num_attention_heads
+    kv_hidden = hidden * (getattr(config, "num_key_value_heads", None) or heads) // heads
+    # query and output projections, key and value projections (grouped for GQA models), gated MLP
+    linear = config.num_hidden_layers * (2 * hidden * hidden + 2 * hidden * kv_hidden + 3 * hidden * config.intermediate_size)
+    embeddings = config.vocab_size * hidden * (1 if getattr(config, "tie_word_embeddings", False) else 2)
+    linear_bytes = {None: 4, "int8": 1, "int4": 0.5}[quantize]
+    return (linear + embeddings) * 4 / 2**30, (linear * linear_bytes + embeddings * 4) / 2**30
+
+
+def available_memory_gb():
+    """Memory the kernel can hand out without swapping, from /proc/meminfo (Linux), or None elsewhere."""
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) / 2**20
+    except OSError:
+        return None
+
+
+def check_memory(model_name, quantize=None, max_memory_gb=None):
+    """Raise MemoryError before loading `model_name` when its estimated peak memory exceeds the budget."""
+    peak, loaded = estimate_memory_gb(model_name, quantize)
+    print(f"{model_name}: about {peak:.1f} GB to load, {loaded:.1f} GB loaded ({quantize or 'float32'})")
+    limits = [limit for limit in [max_memory_gb, available_memory_gb()] if limit is not None]
+    if not limits:
+        return
+    budget = min(limits)
+    if peak > budget:
+        raise MemoryError(f"{model_name} needs about {peak:.1f} GB to load, more than the {budget:.1f} GB budget")
+
+
+def load_cpu_model(model_name, quantize=None, **kwargs):
+    """
+    Load `model_name` in float32 on CPU, with the weights of its linear layers in "int8" (torch dynamic
+    quantization) or "int4" (optimum-quanto). `kwargs` go to `from_pretrained`.
+    """
+    quantization_config = None
+    if quantize == "int4":
+        # imported here: the int4 CPU kernels need the optional optimum-quanto package
+        from transformers import QuantoConfig
+        quantization_config = QuantoConfig(weights="int4")
+    model = AutoModelForCausalLM.from_pretrained(
+        model_name,
+        torch_dtype=torch.float32,
+        low_cpu_mem_usage=True,
+        quantization_config=quantization_config,
+        **kwargs,
+    )
+    if quantize == "int8":
+        # weights are stored in int8 and activations quantized on the fly in every linear layer
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    return model.eval()
@@ -0,0 +1,74 @@
+import numpy as np
+
+# Dominance pruning of the candidate rows handed to the solver encoders. Every function returns the
+# positions of the rows to keep, in table order, and only drops a row when some kept row can stand in
+# for it in any plan that satisfies the query JSON (same effect on the constraints, no higher cost).
+
+# bit positions in the room type / house rule masks of the accommodation tools (_TYPES_RULES)
+_ROOM_TYPE_BITS = {'private room': 0, 'entire room': 1, 'shared room': 2}
+_HOUSE_RULE_BITS = {'visitors': 3, 'smoking': 4, 'parties': 5, 'children under 10': 6, 'pets': 7}
+# bit positions in the cuisine masks of the restaurant tools (_CUISINES)
+_CUISINE_BITS = {'Chinese': 0, 'American': 1, 'Italian': 2, 'Mexican': 3, 'Indian': 4, 'Mediterranean': 5, 'French': 6}
+
+
+def flight_positions(prices, arrivals):
+    """
+    Flights on one leg only differ to the solver by price and arrival time, so keep the cheapest
+    flight (the first one on ties) of every arrival time.
+    """
+    order = np.argsort(np.asarray(prices), kind='stable')
+    _, first = np.unique(np.asarray(arrivals)[order], return_index=True)
+    return np.sort(order[first])
+
+
+def accommodation_positions(prices, minimum_nights, maximum_occupancy, room_types, house_rules, query):
+    """
+    Keep the listings of one city that the query's room type and house rule allow, then the Pareto
+    front of (price of the rooms the group needs per night, minimum nights).
+    """
+    constraint = query.get('local_constraint') or {}
+    keep = np.ones(len(prices), dtype=bool)
+    room_type = constraint.get('room type')
+    if room_type == 'not shared room':
+        keep &= (room_types >> _ROOM_TYPE_BITS['shared room'] & 1) == 0
+    elif room_type in _ROOM_TYPE_BITS:
+        keep &= (room_types >> _ROOM_TYPE_BITS[room_type] & 1) == 1
+    house_rule = constraint.get('house rule')
+    if house_rule in _HOUSE_RULE_BITS:
+        keep &= (house_rules >> _HOUSE_RULE_BITS[house_rule] & 1) == 0
+
+    positions = np.flatnonzero(keep)
+    occupancy = maximum_occupancy[positions].astype(float)
+    with np.errstate(divide='ignore'):
+        rooms = np.where(occupancy > 0, np.ceil(query.get('people_number', 1) / occupancy), np.inf)
+    cost = rooms * prices[positions]
+    nights = minimum_nights[positions]
+    front = []
+    fewest_nights = np.inf
+    # cheapest first, fewer minimum nights first among equal costs
+    for position in np.lexsort((nights, cost)):
+        if nights[position] < fewest_nights:
+            front.append(positions[position])
+            fewest_nights = nights[position]
+    return np.sort(np.array(front, dtype=np.int64))
+
+
+def restaurant_positions(prices, cuisines, query):
+    """
+    Restaurants of one city only differ to the solver by price and by which of the query's cuisines
+    they serve, and no restaurant is visited twice, so keep the 3 * days cheapest of every such group.
+    """
+    wanted = 0
+    for cuisine in (query.get('local_constraint') or {}).get('cuisine') or []:
+        if cuisine in _CUISINE_BITS:
+            wanted |= 1 << _CUISINE_BITS[cuisine]
+    meals = 3 * query['days']
+    groups = np.asarray(cuisines, dtype=np.int64) & wanted
+    kept = []
+    counts = {}
+    for position in np.argsort(np.asarray(prices), kind='stable'):
+        group = groups[position]
+        if counts.get(group, 0) < meals:
+            kept.append(position)
+            counts[group] = counts.get(group, 0) + 1
+    return np.sort(np.array(kept, dtype=np.int64))
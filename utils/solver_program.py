@@ -0,0 +1,59 @@
+import re
+import time
+import functools
+
+# name of the timing hook the timed source calls ahead of every segment
+_MARK = '__solver_segment__'
+
+
+# Running the same program again (a retry, a repair round that changed nothing) skips parsing and compiling
+# it; only the most recent programs are kept, so long runs over many queries do not hold on to all of them.
+@functools.lru_cache(maxsize=16)
+def compile_program(source, filename='<solver>'):
+    return compile(source, filename, 'exec')
+
+
+def _marked(name, code):
+    # the mark goes right before the first statement, at its indentation, which is valid wherever the segment is
+    match = re.search(r'^([ \t]*)(?!#)\S', code, flags=re.M)
+    if match is None:
+        return code
+    return code[:match.start()] + '{}{}({!r})\n'.format(match.group(1), _MARK, name) + code[match.start():]
+
+
+class SolverProgram:
+    """
+    A generated solver program as its ordered (name, code) segments: the step codes and the solve template.
+    The steps are spliced into the loops of the destination code, so the segments only compile together;
+    the program is compiled once per distinct source, and with `timed` every segment is preceded by a mark
+    so that `times` adds up the seconds from each segment to the next one, over all loop iterations.
+    """
+
+    def __init__(self, segments, timed=False):
+        self.segments = list(segments)
+        self.timed = timed
+        self.times = {}
+        self._current = None
+        self._since = None
+
+    @property
+    def source(self):
+        """The program as it is written to codes.txt."""
+        return ''.join(code for _, code in self.segments)
+
+    def _mark(self, name):
+        now = time.perf_counter()
+        if self._current is not None:
+            self.times[self._current] = self.times.get(self._current, 0.0) + now - self._since
+        self._current, self._since = name, now
+
+    def run(self, globals, locals):
+        if not self.timed:
+            exec(compile_program(self.source), globals, locals)
+            return
+        source = ''.join(_marked(name, code) for name, code in self.segments)
+        locals[_MARK] = self._mark
+        try:
+            exec(compile_program(source, '<timed solver>'), globals, locals)
+        finally:
+            self._mark(None)
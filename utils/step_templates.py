@@ -0,0 +1,46 @@
+import re
+
+from utils.llm_cache import cached_response
+
+# Step texts of different queries often only differ in the origin, the destination, the dates and the
+# budget. Those literals are swapped for placeholders so that the code generated for one query's step
+# can be reused for another query with the same template. Small numbers (people, days, transportations)
+# are left as they are: they cannot be told apart reliably and they shape the generated code.
+
+
+def step_literals(query):
+    """Return the (placeholder, literal) pairs of the query JSON, in the order they are substituted."""
+    literals = [('<<DATE_{}>>'.format(i), date) for i, date in enumerate(query.get('date') or [])]
+    cities = [('<<ORIGIN>>', query.get('org')), ('<<DESTINATION>>', query.get('dest'))]
+    # longer names first, so that a city named inside a longer name is not replaced in it
+    literals += sorted([(placeholder, city) for placeholder, city in cities if city], key=lambda literal: -len(literal[1]))
+    if query.get('budget') is not None:
+        literals.append(('<<BUDGET>>', str(query['budget'])))
+    return literals
+
+
+def templatize(text, literals):
+    if text is None:
+        return None
+    for placeholder, literal in literals:
+        text = re.sub(r'(?<![\w-]){}(?![\w-])'.format(re.escape(literal)), placeholder, text)
+    return text
+
+
+def instantiate(template, literals):
+    if template is None:
+        return None
+    for placeholder, literal in literals:
+        template = template.replace(placeholder, literal)
+    return template
+
+
+def templated_step_code(settings, prompt, lines, query, request):
+    """
+    Return the code for the step `lines`, generated with `request(lines)` only the first time its template
+    is seen under `settings` (the model and its version) and `prompt`, and instantiated for `query` after.
+    """
+    literals = step_literals(query)
+    template = cached_response(['step template'] + settings, prompt + templatize(lines, literals),
+                               lambda: templatize(request(lines), literals))
+    return instantiate(template, literals)